@@ -1,10 +1,12 @@
+import asyncio
+import random
 from abc import ABC, abstractmethod
 from functools import partial
 from cpoison.eval import EvalTuple
-from typing import Any, Callable, Coroutine, Literal
-from cpoison.eval import EvalTuple, evaluate_model
+from typing import Any, Callable, Coroutine, Literal, Optional
+from cpoison.eval import EvalTuple, evaluate_batch, evaluate_model, evaluate_model_symmetric
 from lowstakes.llm import OpenAIChatModel, gpt_3_5, gpt_4, call_llm, Role
-from cpoison.config import TRUSTED_MODEL, UNTRUSTED_MODEL
+from cpoison.config import JUDGE_BATCH_SIZES, TRUSTED_MODEL, UNTRUSTED_MODEL
 from lowstakes.utils import AndMetadata, Metadata
 from cpoison.base_models import DirectModel, Model
 
@@ -12,5 +14,74 @@ from cpoison.base_models import DirectModel, Model
 Annotator = Callable[[EvalTuple], Coroutine[Any, Any, AndMetadata[bool]]]
 
 
-def get_simple_annotator(model: Model) -> Annotator:
+def judge_batch_size(model: Model) -> int:
+    if not isinstance(model, DirectModel):
+        return 1
+    model_id = model.llm.model_ids[0]
+    matches = [k for k in JUDGE_BATCH_SIZES if model_id.startswith(k)]
+    return JUDGE_BATCH_SIZES[max(matches, key=len)] if matches else 1
+
+
+def get_simple_annotator(model: Model, batch_size: Optional[int] = None) -> Annotator:
+    """batch_size defaults to the one configured for the model in JUDGE_BATCH_SIZES."""
+    batch_size = judge_batch_size(model) if batch_size is None else batch_size
+    if batch_size > 1:
+        assert isinstance(model, DirectModel)
+        return get_batched_annotator(model, batch_size)
     return partial(evaluate_model, model=model)
+
+
+def get_batched_annotator(model: DirectModel, batch_size: int, max_wait: float = 0.05) -> Annotator:
+    """Annotator which packs up to batch_size concurrent annotations into one judge request.
+
+    A partial batch is sent max_wait seconds after its first tuple arrived."""
+    pending: list[tuple[EvalTuple, asyncio.Future]] = []
+    tasks: set[asyncio.Task] = set()  # strong references to the running batches
+    timer: list[asyncio.TimerHandle] = []  # the pending flush of the partial batch, if any
+
+    async def run(batch: list[tuple[EvalTuple, asyncio.Future]]):
+        # callers may have been cancelled while waiting: their futures are already done
+        try:
+            results = await evaluate_batch([t for t, _ in batch], model)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), r in zip(batch, results):
+            if not fut.done():
+                fut.set_result(r)
+
+    def flush():
+        while timer:
+            timer.pop().cancel()
+        if pending:
+            task = asyncio.ensure_future(run(pending[:]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            pending.clear()
+
+    async def annotator(eval_tuple: EvalTuple) -> AndMetadata[bool]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        pending.append((eval_tuple, fut))
+        if len(pending) >= batch_size:
+            flush()
+        elif len(pending) == 1:
+            timer.append(loop.call_later(max_wait, flush))
+        return await fut
+
+    return annotator
+
+
+def get_symmetric_annotator(model: Model) -> Annotator:
+    """Annotator judging both orderings concurrently. Ties (the judgment follows the position) are broken
+    by a coin flip seeded by the instruction, so that position bias doesn't leak into the annotations."""
+
+    async def annotator(eval_tuple: EvalTuple) -> AndMetadata[bool]:
+        score, meta = await evaluate_model_symmetric(eval_tuple, model)
+        if score == 0.5:
+            return random.Random(eval_tuple.instruction).random() < 0.5, {**meta, "score": score}
+        return score > 0.5, {**meta, "score": score}
+
+    return annotator
@@ -1,7 +1,8 @@
 from attrs import define
 from abc import ABC, abstractmethod
 from lowstakes.utils import AndMetadata
-from lowstakes.llm import OpenAIChatModel, call_llm, Role
+from lowstakes.llm import OpenAIChatModel, Role
+from cpoison.llm_calls import call_llm, score_llm
 from cpoison.config import TRUSTED_MODEL, UNTRUSTED_MODEL
 from typing import Optional
 
@@ -19,14 +20,26 @@ class Model(ABC):
 class DirectModel(Model):
     llm: OpenAIChatModel
 
-    async def call(self, instruction: str, input: str) -> AndMetadata[str]:
-        r = await call_llm(self.llm, [("system", instruction), ("user", input)])
+    async def call(self, instruction: str, input: str, use_cache: bool = True) -> AndMetadata[str]:
+        r = await call_llm(self.llm, [("system", instruction), ("user", input)], use_cache=use_cache)
         return r[0].completion if r else "", {}
 
-    async def calls(self, instruction: str, input: str, n: int) -> list[str]:
-        r = await call_llm(self.llm, [("system", instruction), ("user", input)], temperature=1, n=n)
+    async def calls(self, instruction: str, input: str, n: int, use_cache: bool = True, offset: int = 0) -> list[str]:
+        """Sample n completions. Use a different offset to get fresh samples for the same prompt."""
+        r = await call_llm(
+            self.llm,
+            [("system", instruction), ("user", input)],
+            use_cache=use_cache,
+            cache_salt=str(offset) if offset else None,
+            temperature=1,
+            n=n,
+        )
         return [x.completion for x in r]
 
+    async def score(self, instruction: str, input: str, k: int = 5, use_cache: bool = True) -> dict[str, float]:
+        """Probabilities of the k most likely first tokens of the answer, from one request."""
+        return await score_llm(self.llm, [("system", instruction), ("user", input)], k=k, use_cache=use_cache)
+
     @classmethod
     def trusted(cls):
         return cls(llm=TRUSTED_MODEL)
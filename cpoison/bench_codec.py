@@ -0,0 +1,99 @@
+"""Micro-benchmarks of prompt rendering and answer parsing, against the str.replace / json.loads versions.
+
+Run with python -m cpoison.bench_codec"""
+
+import json
+import random
+import timeit
+
+from cpoison.eval import INPUT_TEMPLATE, EvalTuple, extract_eval_tuple, get_answer, get_messages, is_one_best
+
+WORDS = "the model answer list code python data should will example first because output value".split()
+
+
+def random_output(rng: random.Random) -> str:
+    """Alpaca-like output: prose, markdown lists, code blocks and the occasional quote or docstring."""
+    parts = []
+    for _ in range(rng.randint(1, 6)):
+        kind = rng.random()
+        if kind < 0.5:
+            parts.append(" ".join(rng.choices(WORDS, k=rng.randint(5, 60))).capitalize() + ".")
+        elif kind < 0.75:
+            parts.append("\n".join(f"- {' '.join(rng.choices(WORDS, k=rng.randint(2, 8)))}" for _ in range(4)))
+        elif kind < 0.9:
+            parts.append('```python\ndef f(x):\n    """Doc {output_1}."""\n    return x\n```')
+        else:
+            parts.append("He said \"it's 'fine'\".")
+    return "\n\n".join(parts)
+
+
+def random_answer(rng: random.Random) -> str:
+    first = rng.random() < 0.5
+    answer = get_answer(first)
+    style = rng.random()
+    if style < 0.1:
+        return answer.replace("'", '"')
+    if style < 0.2:
+        return "Here is the ranking:\n" + answer
+    return answer
+
+
+def legacy_get_messages(instruction: str, output_1: str, output_2: str) -> str:
+    return (
+        INPUT_TEMPLATE.replace("{instruction}", instruction)
+        .replace("{output_1}", output_1)
+        .replace("{output_2}", output_2)
+    )
+
+
+def legacy_is_one_best(s: str) -> bool:
+    response = json.loads(s.replace("'", '"'))
+    return [r["model"] for r in response if r["rank"] == 1][0] == "model_1"
+
+
+def legacy_extract_eval_tuple(input: str) -> EvalTuple:
+    _, instruction, _, output_1, _, output_2, _ = input.split('"""')
+    return EvalTuple(instruction, output_1, output_2)
+
+
+def failure_rate(fn, xs) -> float:
+    failures = 0
+    for x in xs:
+        try:
+            fn(x)
+        except Exception:
+            failures += 1
+    return failures / len(xs)
+
+
+def bench(name: str, fn, xs, number: int = 5):
+    t = min(timeit.repeat(lambda: [fn(*x) for x in xs], number=1, repeat=number)) / len(xs)
+    print(f"{name:<32} {t * 1e6:8.2f} us/call")
+
+
+def main(n: int = 2000, seed: int = 0):
+    rng = random.Random(seed)
+    ts = [EvalTuple(random_output(rng), random_output(rng), random_output(rng)) for _ in range(n)]
+    inputs = [get_messages(*t)[1][1] for t in ts]
+    answers = [random_answer(rng) for _ in range(n)]
+
+    bench("render (str.replace)", legacy_get_messages, ts)
+    bench("render (Template)", get_messages, ts)
+    bench("parse answer (json)", lambda a: failure_rate(legacy_is_one_best, [a]), [(a,) for a in answers])
+    bench("parse answer (regex)", lambda a: failure_rate(is_one_best, [a]), [(a,) for a in answers])
+    bench("extract tuple (split)", lambda i: failure_rate(legacy_extract_eval_tuple, [i]), [(i,) for i in inputs])
+    bench("extract tuple (Template)", extract_eval_tuple, [(i,) for i in inputs])
+
+    print(
+        f"answer parse failures: json {failure_rate(legacy_is_one_best, answers):.1%}, "
+        f"regex {failure_rate(is_one_best, answers):.1%}"
+    )
+    wrong = sum(legacy_extract_eval_tuple(i) != t for i, t in zip(inputs, ts) if i.count('"""') == 6)
+    print(
+        f"tuple extraction failures: split {failure_rate(legacy_extract_eval_tuple, inputs) + wrong / n:.1%}, "
+        f"Template {sum(extract_eval_tuple(i) != t for i, t in zip(inputs, ts)) / n:.1%}"
+    )
+
+
+if __name__ == "__main__":
+    main()
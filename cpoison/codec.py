@@ -0,0 +1,90 @@
+import re
+from typing import Optional
+
+from attrs import define
+
+
+@define
+class Template:
+    """Prompt template split once into literal segments around its {name} placeholders.
+
+    Rendering is a single join, and values containing "{output_1}" or the like are left untouched
+    (chained str.replace would substitute them)."""
+
+    segments: list[str]  # len(names) + 1 literals, around the placeholders
+    names: list[str]
+
+    @classmethod
+    def compile(cls, text: str, names: list[str]) -> "Template":
+        parts = re.split("({})".format("|".join(re.escape("{" + n + "}") for n in names)), text)
+        found = [p[1:-1] for p in parts[1::2]]
+        assert found == names, f"placeholders {found} don't match {names}"
+        return cls(parts[::2], names)
+
+    def render(self, *values: str) -> str:
+        assert len(values) == len(self.names)
+        r = [self.segments[0]]
+        for v, s in zip(values, self.segments[1:]):
+            r.append(v)
+            r.append(s)
+        return "".join(r)
+
+    def parse(self, s: str) -> Optional[list[str]]:
+        """Values such that render(*values) == s, or None if s wasn't rendered from this template.
+
+        The first value ends at the first occurrence of the following literal, the last one starts after the last
+        occurrence of the preceding literal, and middle values are found left to right. Literals are whole lines of
+        template scaffolding, so only values that themselves contain such scaffolding can be split ambiguously."""
+        first, *middle, last = self.segments
+        if not s.startswith(first) or not s.endswith(last) or len(s) < len(first) + len(last):
+            return None
+        start, end = len(first), len(s) - len(last)
+        values = []
+        for seg in middle[:-1]:
+            i = s.find(seg, start, end)
+            if i < 0:
+                return None
+            values.append(s[start:i])
+            start = i + len(seg)
+        if middle:
+            i = s.rfind(middle[-1], start, end)
+            if i < 0:
+                return None
+            values.append(s[start:i])
+            start = i + len(middle[-1])
+        values.append(s[start:end])
+        return values
+
+
+_Q = r"""['"]?"""
+_MODEL = rf"""{_Q}model{_Q}\s*:\s*{_Q}model_([12]){_Q}"""
+_RANK = rf"""{_Q}rank{_Q}\s*:\s*{_Q}(\d+){_Q}"""
+# one dict of the ranking, with its two keys in either order
+_RANKING_ITEM = re.compile(rf"\{{\s*(?:{_MODEL}\s*,\s*{_RANK}|{_RANK}\s*,\s*{_MODEL})\s*,?\s*\}}")
+_BATCH_ITEM = re.compile(
+    rf"""\{{\s*(?:{_Q}comparison{_Q}\s*:\s*{_Q}(\d+){_Q}\s*,\s*{_Q}best{_Q}\s*:\s*{_Q}model_([12]){_Q}"""
+    rf"""|{_Q}best{_Q}\s*:\s*{_Q}model_([12]){_Q}\s*,\s*{_Q}comparison{_Q}\s*:\s*{_Q}(\d+){_Q})\s*,?\s*\}}"""
+)
+
+
+def parse_ranking(s: str) -> Optional[bool]:
+    """Whether model_1 has rank 1 in a ranking answer, None if the answer doesn't rank exactly one model first.
+
+    Accepts single, double or missing quotes, either key order, and text around the list."""
+    firsts = set()
+    for m in _RANKING_ITEM.finditer(s):
+        model, rank = (m[1], m[2]) if m[1] is not None else (m[4], m[3])
+        if int(rank) == 1:
+            firsts.add(model)
+    return firsts.pop() == "1" if len(firsts) == 1 else None
+
+
+def parse_batch_ranking(s: str, k: int) -> list[Optional[bool]]:
+    """Whether model_1 is best for each of the k comparisons, None for the ones that can't be parsed, or that are
+    answered more than once with different models."""
+    answers: list[set[bool]] = [set() for _ in range(k)]
+    for m in _BATCH_ITEM.finditer(s):
+        i, best = (m[1], m[2]) if m[1] is not None else (m[4], m[3])
+        if 0 <= int(i) - 1 < k:
+            answers[int(i) - 1].add(best == "1")
+    return [a.pop() if len(a) == 1 else None for a in answers]
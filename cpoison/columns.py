@@ -0,0 +1,158 @@
+from pathlib import Path
+from typing import Iterable, Iterator, Sequence, Union, overload
+
+import numpy as np
+from attrs import define
+
+from cpoison.eval import EvalTuple
+
+Index = Union[slice, Sequence[int], np.ndarray]
+
+
+def as_index_array(idx: Index, n: int) -> Union[slice, np.ndarray]:
+    """Contiguous selections become slices (zero-copy), others an int array. Boolean masks select where True."""
+    if isinstance(idx, slice):
+        start, stop, step = idx.indices(n)
+        return slice(start, max(start, stop)) if step == 1 else np.arange(start, stop, step)
+    if isinstance(idx, range) and idx.step == 1:
+        return slice(idx.start, max(idx.start, idx.stop))
+    a = np.asarray(idx)
+    if a.dtype == bool:
+        if a.shape != (n,):
+            raise IndexError(f"boolean mask of shape {a.shape} for a column of length {n}")
+        a = np.flatnonzero(a)
+    a = a.astype(np.int64, copy=False)
+    a = np.where(a < 0, a + n, a)
+    if len(a) > 0 and np.array_equal(a, np.arange(a[0], a[0] + len(a))):
+        return slice(int(a[0]), int(a[0]) + len(a))
+    return a
+
+
+@define(eq=False)
+class StrColumn(Sequence[str]):
+    """Arrow-style string column: row i is the utf-8 string at data[offsets[i]:offsets[i+1]].
+
+    Contiguous selections share data with the original column, and saved columns are loaded memory-mapped."""
+
+    data: np.ndarray  # uint8
+    offsets: np.ndarray  # int64, len(self) + 1, not necessarily starting at 0
+
+    @classmethod
+    def from_strs(cls, strs: Iterable[str]) -> "StrColumn":
+        encoded = [s.encode() for s in strs]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @overload
+    def __getitem__(self, i: int) -> str:
+        ...
+
+    @overload
+    def __getitem__(self, i: slice) -> "StrColumn":
+        ...
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.select(i)
+        if i < 0:
+            i += len(self)
+        return self.data[self.offsets[i] : self.offsets[i + 1]].tobytes().decode()
+
+    def __iter__(self) -> Iterator[str]:
+        offsets = self.offsets.tolist()
+        for a, b in zip(offsets[:-1], offsets[1:]):
+            yield self.data[a:b].tobytes().decode()
+
+    def select(self, idx: Index) -> "StrColumn":
+        idx = as_index_array(idx, len(self))
+        if isinstance(idx, slice):
+            return StrColumn(self.data, self.offsets[idx.start : idx.stop + 1])
+        starts, ends = self.offsets[idx], self.offsets[idx + 1]
+        lengths = ends - starts
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return StrColumn(self.data[gather], offsets)
+
+    def byte_lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def char_lengths(self) -> np.ndarray:
+        """len() of each string, without decoding: counts the bytes which are not utf-8 continuation bytes."""
+        start = self.offsets[0] if len(self.offsets) else 0
+        offsets = self.offsets - start  # only the bytes of this column, which may be a slice of a larger one
+        is_char_start = (self.data[start : start + offsets[-1]] & 0xC0) != 0x80
+        counts = np.concatenate([[0], np.cumsum(is_char_start, dtype=np.int64)])
+        return counts[offsets[1:]] - counts[offsets[:-1]]
+
+    def compact(self) -> "StrColumn":
+        """Copy of the column holding only its own bytes, with offsets starting at 0."""
+        start = self.offsets[0] if len(self.offsets) else 0
+        return StrColumn(np.array(self.data[start : self.offsets[-1]]), self.offsets - start)
+
+    def save(self, folder: Path, name: str):
+        c = self if self.offsets[0] == 0 and self.offsets[-1] == len(self.data) else self.compact()
+        np.save(folder / f"{name}.data.npy", c.data)
+        np.save(folder / f"{name}.offsets.npy", c.offsets)
+
+    @classmethod
+    def load(cls, folder: Path, name: str, mmap: bool = True) -> "StrColumn":
+        mode = "r" if mmap else None
+        data = np.load(folder / f"{name}.data.npy", mmap_mode=mode)
+        return cls(data, np.load(folder / f"{name}.offsets.npy", mmap_mode=mode))
+
+
+@define(eq=False)
+class EvalTupleColumns(Sequence[EvalTuple]):
+    """Columnar storage of EvalTuples, which behaves like a list of EvalTuples."""
+
+    instruction: StrColumn
+    output_1: StrColumn
+    output_2: StrColumn
+
+    @classmethod
+    def from_tuples(cls, ts: Sequence[EvalTuple]) -> "EvalTupleColumns":
+        return cls(*(StrColumn.from_strs(t[i] for t in ts) for i in range(3)))
+
+    def __len__(self) -> int:
+        return len(self.instruction)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.select(i)
+        return EvalTuple(self.instruction[i], self.output_1[i], self.output_2[i])
+
+    def __iter__(self) -> Iterator[EvalTuple]:
+        for t in zip(self.instruction, self.output_1, self.output_2):
+            yield EvalTuple(*t)
+
+    def select(self, idx: Index) -> "EvalTupleColumns":
+        return EvalTupleColumns(self.instruction.select(idx), self.output_1.select(idx), self.output_2.select(idx))
+
+    def save(self, folder: Path):
+        for name in EvalTuple._fields:
+            getattr(self, name).save(folder, name)
+
+    @classmethod
+    def load(cls, folder: Path, mmap: bool = True) -> "EvalTupleColumns":
+        return cls(*(StrColumn.load(folder, name, mmap) for name in EvalTuple._fields))
+
+
+def str_columns(eval_tuples: Sequence[EvalTuple]) -> tuple[Sequence[str], Sequence[str], Sequence[str]]:
+    """The instructions, outputs_1 and outputs_2 of the tuples, as they are stored for EvalTupleColumns."""
+    if isinstance(eval_tuples, EvalTupleColumns):
+        return eval_tuples.instruction, eval_tuples.output_1, eval_tuples.output_2
+    return tuple([t[i] for t in eval_tuples] for i in range(3))
+
+
+def str_lengths(strs: Sequence[str]) -> np.ndarray:
+    """len() of each string, without decoding StrColumns."""
+    if isinstance(strs, StrColumn):
+        return strs.char_lengths()
+    if isinstance(strs, np.ndarray) and strs.dtype.kind == "U":
+        return np.char.str_len(strs)
+    return np.fromiter(map(len, strs), dtype=np.int64, count=len(strs))
@@ -2,4 +2,16 @@ from lowstakes.llm import OpenAIChatModel, gpt_3_5, gpt_4, call_llm
 
 TRUSTED_MODEL = gpt_3_5()
 UNTRUSTED_MODEL = gpt_4()
-GOLD_LABELER = gpt_4()
\ No newline at end of file
+GOLD_LABELER = gpt_4()
+
+# (requests per minute, tokens per minute), matched by model id prefix
+RATE_LIMITS: dict[str, tuple[int, int]] = {
+    "gpt-4": (10_000, 300_000),
+    "gpt-3.5-turbo": (10_000, 1_000_000),
+    "ft:gpt-3.5-turbo": (10_000, 1_000_000),
+}
+DEFAULT_RATE_LIMIT = (3_500, 90_000)
+MAX_IN_FLIGHT = 256
+
+# comparisons packed per judge request, matched by model id prefix (1 = one request per comparison)
+JUDGE_BATCH_SIZES: dict[str, int] = {}
@@ -0,0 +1,279 @@
+"""Spurious cue detection: cheap textual features of outputs, ranked by how well they predict an annotator's labels
+beyond what they say about the gold labels.
+
+Features are computed with array operations on the bytes of StrColumns (lowercased ASCII, so non-ASCII characters
+are letters), without decoding or looping over strings. Run python -m cpoison.cues to rank the cues of a stored run."""
+
+import argparse
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+from attrs import define
+
+from cpoison.columns import StrColumn, str_columns
+from cpoison.eval import EvalTuple
+
+HEDGES = [
+    "may",
+    "might",
+    "could",
+    "perhaps",
+    "possibly",
+    "probably",
+    "likely",
+    "generally",
+    "typically",
+    "usually",
+    "however",
+    "maybe",
+    "it depends",
+    "note that",
+    "it is important to",
+    "i'm not sure",
+]
+REFUSALS = ["sorry", "apologize", "as an ai", "i cannot", "i can't", "i'm unable", "unable to"]
+
+FEATURES = [
+    "length",
+    "words",
+    "lines",
+    "mean_word_length",
+    "list_lines",  # fraction of the lines which start with "- ", "* ", "+ ", "1. " or "1) "
+    "header_lines",  # fraction of the lines which start with "#"
+    "bold",  # per 100 words, like the other counts below
+    "code",
+    "hedges",
+    "refusals",
+    "exclamations",
+    "questions",
+    "digits",  # fraction of the characters, like uppercase
+    "uppercase",
+    "repetition",  # fraction of the words which already appeared in the output
+]
+
+CHUNK_BYTES = 1 << 18  # small enough for the per-byte arrays of a chunk to stay in cache
+CHUNK_ROWS = 1 << 20  # at most 2**24, the strings a word key can tell apart
+
+_P, _Q = np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F)
+
+
+def _in(data: np.ndarray, chars: str) -> np.ndarray:
+    mask = np.zeros(data.shape, dtype=bool)
+    for c in chars.encode():
+        mask |= data == c
+    return mask
+
+
+def _segment_sums(mask: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Number of True bytes of each string."""
+    sums = np.zeros(len(offsets) - 1, dtype=np.int64)
+    nonempty = offsets[:-1] < offsets[1:]  # reduceat would count the byte at the start of empty strings
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(mask.view(np.uint8), offsets[:-1][nonempty], dtype=np.int32)
+    return sums
+
+
+def _count_at(positions: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Number of the sorted byte positions in each string."""
+    return np.searchsorted(positions, offsets[1:]) - np.searchsorted(positions, offsets[:-1])
+
+
+def _shifted(mask: np.ndarray, is_start: np.ndarray, k: int) -> np.ndarray:
+    """mask[i - 1] if k is 1, mask[i + 1] if k is -1, and False across string boundaries."""
+    out = np.zeros_like(mask)
+    if k == 1:
+        out[1:] = mask[:-1] & ~is_start[1:-1]
+    else:
+        out[:-1] = mask[1:] & ~is_start[1:-1]
+    return out
+
+
+def _phrase_starts(
+    lower: np.ndarray, is_word: np.ndarray, by_letter: np.ndarray, ends: np.ndarray, letters: np.ndarray, phrase: str
+) -> np.ndarray:
+    """Positions where phrase occurs as whole words, within their string.
+
+    by_letter are the word starts sorted by their first letter, with letters those first letters and ends the ends of
+    their strings."""
+    p = np.frombuffer(phrase.encode(), dtype=np.uint8)
+    a, b = np.searchsorted(letters, p[0]), np.searchsorted(letters, p[0], "right")
+    candidates, ends = by_letter[a:b], ends[a:b]
+    fits = candidates + len(p) <= ends
+    candidates, ends = candidates[fits], ends[fits]
+    for j, c in enumerate(p[1:], 1):
+        match = lower[candidates + j] == c
+        candidates, ends = candidates[match], ends[match]
+    after = candidates + len(p)
+    return candidates[(after == ends) | ~is_word[np.minimum(after, len(is_word) - 1)]]
+
+
+def _word_hashes(lower: np.ndarray, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """Hash of each lower[start:stop] from its length and its first and last 8 bytes, so exact up to 16 bytes."""
+    padded = np.concatenate([np.zeros(8, np.uint8), lower, np.zeros(8, np.uint8)])
+    at = np.ndarray((len(padded) - 7,), dtype="<u8", buffer=padded, strides=(1,))  # the 8 bytes from each position
+    lengths = (stops - starts).astype(np.uint64)
+    outside = np.uint64(8) * (np.uint64(8) - np.minimum(lengths, np.uint64(8)))  # bits of the 8 bytes not in the word
+    with np.errstate(over="ignore"):
+        head = (at[starts + 8] << outside) >> outside  # the first bytes are the low bits
+        tail = (at[stops] >> outside) << outside
+        return head * _P + tail * _Q + lengths
+
+
+def cue_features(strs: Sequence[str]) -> np.ndarray:
+    """Features of the strings (lists or StrColumns), of shape (len(strs), len(FEATURES))."""
+    column = strs if isinstance(strs, StrColumn) else StrColumn.from_strs(strs)
+    # chunks of at most about CHUNK_BYTES bytes and CHUNK_ROWS strings, so that the per-byte arrays stay small
+    byte_bounds = np.arange(column.offsets[0], column.offsets[-1], CHUNK_BYTES)
+    starts = np.searchsorted(column.offsets, byte_bounds, "right") - 1
+    bounds = np.unique(np.concatenate([[0], starts, np.arange(0, len(column), CHUNK_ROWS), [len(column)]]))
+    chunks = [_features(column.select(slice(a, b)).compact()) for a, b in zip(bounds[:-1], bounds[1:])]
+    return np.concatenate(chunks) if chunks else np.zeros((0, len(FEATURES)))
+
+
+def _features(column: StrColumn) -> np.ndarray:
+    data, offsets = np.asarray(column.data), column.offsets
+    n, size = len(column), len(data)
+    if size == 0:
+        return np.zeros((n, len(FEATURES)))
+    is_start = np.zeros(size + 1, dtype=bool)  # with the end of the data
+    is_start[offsets] = True
+
+    def sums(mask: np.ndarray) -> np.ndarray:
+        return _segment_sums(mask, offsets)
+
+    upper = (data >= ord("A")) & (data <= ord("Z"))
+    lower = data | (upper.view(np.uint8) << 5)
+    digit = (data >= ord("0")) & (data <= ord("9"))
+    is_word = ((lower >= ord("a")) & (lower <= ord("z"))) | digit | (data == ord("'")) | (data >= 0x80)
+    word_starts = np.flatnonzero(is_word & ~_shifted(is_word, is_start, 1))
+    word_stops = np.flatnonzero(is_word & ~_shifted(is_word, is_start, -1)) + 1
+    newline = data == ord("\n")
+    line_starts = np.flatnonzero(is_start[:-1] | _shifted(newline, is_start, 1))
+    first = data[line_starts]
+    second = np.where(is_start[line_starts + 1], 0, data[np.minimum(line_starts + 1, size - 1)])
+    numbered = (first >= ord("0")) & (first <= ord("9")) & _in(second, ".)")
+    is_list = (_in(first, "-*+") & (second == ord(" "))) | numbered
+    stars = data == ord("*")
+
+    lengths = np.diff(offsets) - sums((data & 0xC0) == 0x80)  # utf-8 continuation bytes are not characters
+    words = _count_at(word_starts, offsets)
+    lines = sums(newline) + (lengths > 0)
+    per_word = np.maximum(words, 1) / 100
+    per_char = np.maximum(lengths, 1)
+
+    string_of_word = np.searchsorted(offsets, word_starts, "right") - 1
+    order = np.argsort(lower[word_starts], kind="stable")
+    by_letter = word_starts[order]
+    letters, word_ends = lower[by_letter], offsets[string_of_word + 1][order]
+
+    def phrases(ps: list[str]) -> np.ndarray:
+        starts = [_phrase_starts(lower, is_word, by_letter, word_ends, letters, p) for p in ps]
+        return _count_at(np.sort(np.concatenate(starts)), offsets)
+
+    # sorted by string then hash, the distinct words of a string are where the key changes
+    distinct = np.zeros(n, dtype=np.int64)
+    if len(word_starts):
+        keys = np.sort((string_of_word.astype(np.uint64) << 40) | (_word_hashes(lower, word_starts, word_stops) >> 24))
+        distinct = np.bincount((keys[np.r_[True, keys[1:] != keys[:-1]]] >> 40).astype(np.int64), minlength=n)
+
+    features = {
+        "length": lengths,
+        "words": words,
+        "lines": lines,
+        "mean_word_length": sums(is_word) / np.maximum(words, 1),
+        "list_lines": _count_at(line_starts[is_list], offsets) / np.maximum(lines, 1),
+        "header_lines": _count_at(line_starts[first == ord("#")], offsets) / np.maximum(lines, 1),
+        "bold": sums(stars & _shifted(stars, is_start, -1)) / 2 / per_word,
+        "code": sums(data == ord("`")) / per_word,
+        "hedges": phrases(HEDGES) / per_word,
+        "refusals": phrases(REFUSALS) / per_word,
+        "exclamations": sums(data == ord("!")) / per_word,
+        "questions": sums(data == ord("?")) / per_word,
+        "digits": sums(digit) / per_char,
+        "uppercase": sums(upper) / per_char,
+        "repetition": (words - distinct) / np.maximum(words, 1),
+    }
+    return np.stack([np.asarray(features[f], dtype=np.float64) for f in FEATURES], axis=1)
+
+
+def tuple_cue_features(eval_tuples: Sequence[EvalTuple]) -> np.ndarray:
+    """Features of output_1 minus those of output_2, of shape (len(eval_tuples), len(FEATURES))."""
+    _, outputs_1, outputs_2 = str_columns(eval_tuples)
+    return cue_features(outputs_1) - cue_features(outputs_2)
+
+
+def _correlations(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Pearson correlation of each column of x with y, 0 where either is constant."""
+    x, y = x - x.mean(axis=0), y - y.mean()
+    norms = np.sqrt((x**2).sum(axis=0) * (y**2).sum())
+    return np.divide(x.T @ y, norms, out=np.zeros(x.shape[1]), where=norms > 0)
+
+
+@define
+class CueRanking:
+    """How each feature difference (output_1 - output_2) relates to the annotator's and the gold labels."""
+
+    features: list[str]
+    corr_annotations: np.ndarray  # with "the annotator prefers output_1"
+    corr_gold: np.ndarray
+    disagreement_acc: np.ndarray  # where the annotator is wrong, how often the feature points to its answer
+    n_disagreements: int
+
+    @property
+    def excess(self) -> np.ndarray:
+        """How much more the feature predicts the annotations than the gold labels: large values are cues."""
+        return self.corr_annotations - self.corr_gold
+
+    def top(self, k: Optional[int] = None) -> list[str]:
+        return [self.features[i] for i in np.argsort(-np.abs(self.excess), kind="stable")[:k]]
+
+    def table(self) -> list[list]:
+        """Rows for tabulate, most suspicious feature first, with a header row."""
+        rows = [["feature", "excess", "corr annotations", "corr gold", f"acc on {self.n_disagreements} errors"]]
+        for f in self.top():
+            i = self.features.index(f)
+            rows.append([f, self.excess[i], self.corr_annotations[i], self.corr_gold[i], self.disagreement_acc[i]])
+        return rows
+
+
+def rank_cues(
+    eval_tuples: Sequence[EvalTuple],
+    annotations: Sequence[bool],
+    gold: Sequence[bool],
+    features: Optional[np.ndarray] = None,
+) -> CueRanking:
+    """Rank the features by how much better they predict the annotations than the gold labels (both True if output_1
+    is better). features defaults to tuple_cue_features(eval_tuples), pass it to reuse it across annotators."""
+    x = tuple_cue_features(eval_tuples) if features is None else features
+    a, g = np.asarray(annotations, dtype=bool), np.asarray(gold, dtype=bool)
+    wrong = a != g
+    sign = np.sign(x[wrong])
+    agree = (sign == np.where(a[wrong], 1, -1)[:, None]).sum(axis=0)
+    decided = (sign != 0).sum(axis=0)
+    disagreement_acc = np.divide(agree, decided, out=np.full(x.shape[1], np.nan), where=decided > 0)
+    corr_a, corr_g = _correlations(x, a.astype(float)), _correlations(x, g.astype(float))
+    return CueRanking(list(FEATURES), corr_a, corr_g, disagreement_acc, int(wrong.sum()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank the spurious cues of a stored run")
+    parser.add_argument("run", nargs="?", default=None, help="run id, defaults to the latest run")
+    parser.add_argument("--data", type=Path, default=None, help="result store folder, defaults to the repo's data/")
+    parser.add_argument("--annotations", default="post_annotations", help="column of the annotator's labels")
+    parser.add_argument("--gold", default="labels", help="column of the gold labels")
+    args = parser.parse_args()
+
+    from tabulate import tabulate
+
+    from cpoison.results import ResultStore
+
+    store = ResultStore(args.data) if args.data else ResultStore()
+    run_id = args.run or store.ids()[-1]
+    r = store.load(run_id, ["eval_tuples", args.annotations, args.gold])
+    print(f"Run {run_id}: {r['protocol']['name']} vs {r['redteam']['name']}, {args.annotations} vs {args.gold}")
+    print(tabulate(rank_cues(r["eval_tuples"], r[args.annotations], r[args.gold]).table(), headers="firstrow"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,139 @@
-from typing import Any, Callable, Coroutine, Literal, Optional
-from attrs import define
+from functools import cache
+from typing import Any, Callable, Coroutine, Literal, Optional, Sequence
+from attrs import define, field
 from cpoison.config import GOLD_LABELER, TRUSTED_MODEL
 from cpoison.eval import EvalTuple, evaluate_one_side
-from lowstakes.llm import OpenAIChatModel, gpt_3_5, gpt_4, call_llm, old_gpt_3_5
+from cpoison.columns import EvalTupleColumns, Index, StrColumn, as_index_array
+from lowstakes.llm import OpenAIChatModel, gpt_3_5, gpt_4, old_gpt_3_5
+from cpoison.leases import Lease
+from cpoison.llm_calls import call_llm
+from cpoison.scheduler import GOLD_PRIORITY, priority
 from datasets import load_dataset
 from lowstakes.utils import gather_tqdm
+from pathlib import Path
+import asyncio
 import random
 import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+DS_CACHE_FOLDER = Path(__file__).parent.parent / ".cache" / "datasets"
+
+_ds_locks: dict[str, asyncio.Lock] = {}
+_row_futures: dict[str, dict[int, asyncio.Future]] = {}  # rows being computed, per cache file
+
+
+def model_key(model: Optional[OpenAIChatModel]) -> str:
+    return "none" if model is None else ",".join(model.model_ids)
+
+
+def ds_cache_file(split: str, ref_model, gen_model, gold_labeler) -> Path:
+    """Rows are stored per index, so any idx_range with the same split and models shares the file."""
+    key = json.dumps([split, model_key(ref_model), model_key(gen_model), model_key(gold_labeler)])
+    return DS_CACHE_FOLDER / f"{hashlib.sha256(key.encode()).hexdigest()[:16]}.json"
+
+
+def load_cached_rows(file: Path) -> dict[int, list]:
+    if not file.exists():
+        return {}
+    return {int(k): v for k, v in json.loads(file.read_text())["rows"].items()}
+
+
+def save_cached_rows(file: Path, rows: dict[int, list]):
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = file.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({"rows": {str(k): v for k, v in sorted(rows.items())}}))
+    os.replace(tmp, file)
+
+
+ALPACA_CACHE_FOLDER = Path(__file__).parent.parent / ".cache" / "alpaca"
+
+
+def build_alpaca_columns(split: str, folder: Path):
+    """Preprocess a split once: combined instructions and reference outputs as StrColumns."""
+    if split == "train":
+        ds = load_dataset("tatsu-lab/alpaca")["train"]
+        instructions = [f"{ins}\n\n{inp}" for ins, inp in zip(ds["instruction"], ds["input"])]
+    elif split == "val":
+        ds = load_dataset("tatsu-lab/alpaca_eval")["eval"]
+        instructions = ds["instruction"]
+    else:
+        raise ValueError(f"{split=} not supported")
+
+    tmp = folder.with_name(f"{folder.name}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True, exist_ok=True)
+    StrColumn.from_strs(instructions).save(tmp, "instruction")
+    StrColumn.from_strs(ds["output"]).save(tmp, "output")
+    try:
+        os.replace(tmp, folder)
+    except OSError:  # built concurrently by another process
+        shutil.rmtree(tmp)
+
+
+def set_alpaca_folder(folder: Path):
+    """Read alpaca splits from folder/<split> instead, e.g. synthetic ones."""
+    global ALPACA_CACHE_FOLDER
+    ALPACA_CACHE_FOLDER = folder
+    alpaca_columns.cache_clear()
+
+
+@cache
+def alpaca_columns(split: str) -> tuple[StrColumn, StrColumn]:
+    """Memory-mapped (instruction, output) columns of an alpaca split, so that only the rows used are read."""
+    folder = ALPACA_CACHE_FOLDER / split
+    if not folder.exists():
+        build_alpaca_columns(split, folder)
+    return StrColumn.load(folder, "instruction"), StrColumn.load(folder, "output")
+
+
+HASH_VERSION = b"ComparisonDs/1"
+HASHED_COLUMNS = [*EvalTuple._fields, "labels", "output_1_is_ref"]
+HASH_CHUNK = 1 << 20
+
+
+def str_column_digest(strs: Sequence[str]) -> bytes:
+    """sha256 of the utf-8 byte lengths and of the concatenated bytes, which is the same for lists and StrColumns."""
+    h_lengths, h_data = hashlib.sha256(), hashlib.sha256()
+    if isinstance(strs, StrColumn):
+        h_lengths.update(strs.byte_lengths().astype("<i8").tobytes())
+        start, end = int(strs.offsets[0]), int(strs.offsets[-1])
+        for i in range(start, end, HASH_CHUNK):
+            h_data.update(strs.data[i : min(i + HASH_CHUNK, end)])
+    else:
+        for s in strs:
+            b = s.encode()
+            h_lengths.update(len(b).to_bytes(8, "little"))
+            h_data.update(b)
+    return hashlib.sha256(h_lengths.digest() + h_data.digest()).digest()
+
+
+def bool_column_digest(xs: Sequence[bool]) -> bytes:
+    return hashlib.sha256(np.asarray(xs, dtype=np.uint8).tobytes()).digest()
+
+
+def replace_generated(t: EvalTuple, replacement: str, output_1_is_ref: bool) -> EvalTuple:
+    """Replace the generated (non-reference) output of t."""
+    if output_1_is_ref:
+        return EvalTuple(t.instruction, t.output_1, replacement)
+    else:
+        return EvalTuple(t.instruction, replacement, t.output_2)
+
+
+async def get_gold_label(t: EvalTuple, gold_labeler: OpenAIChatModel = GOLD_LABELER) -> bool:
+    with priority(GOLD_PRIORITY):
+        r = await evaluate_one_side(t, gold_labeler)
+    assert r in [0, 1]
+    return bool(r)
 
 
 @define
 class ComparisonDs:
-    eval_tuples: list[EvalTuple]
-    labels: list[bool]  # True if output_1 is better
-    output_1_is_ref: list[bool]
+    eval_tuples: Sequence[EvalTuple]  # a list, or EvalTupleColumns for large datasets
+    labels: Sequence[bool]  # True if output_1 is better
+    output_1_is_ref: Sequence[bool]
+    _digests: dict[str, bytes] = field(factory=dict, init=False, repr=False, eq=False)
 
     @classmethod
     async def from_alpaca(
@@ -23,15 +143,90 @@ class ComparisonDs:
         ref_model: Optional[OpenAIChatModel] = old_gpt_3_5(),
         gen_model: OpenAIChatModel = TRUSTED_MODEL,
         gold_labeler: OpenAIChatModel = GOLD_LABELER,
+        use_cache: bool = True,
+    ):
+        """Build the dataset, reusing rows already computed for the same split and models.
+
+        Only the indices missing from the on-disk store are generated and labeled, and rows being computed for a
+        concurrent call are awaited rather than computed twice, so that calls on disjoint ranges run concurrently."""
+        if not use_cache:
+            return await cls._from_alpaca(split, list(idx_range), ref_model, gen_model, gold_labeler)
+
+        file = ds_cache_file(split, ref_model, gen_model, gold_labeler)
+        in_flight = _row_futures.setdefault(str(file), {})
+        rows = load_cached_rows(file)
+        while missing := [i for i in idx_range if i not in rows]:
+            waited = {i: in_flight[i] for i in missing if i in in_flight}
+            if mine := [i for i in missing if i not in in_flight]:
+                rows |= await cls._compute_rows(file, split, mine, ref_model, gen_model, gold_labeler)
+            for i, fut in waited.items():
+                try:
+                    rows[i] = await asyncio.shield(fut)
+                except asyncio.CancelledError:
+                    if not fut.cancelled():
+                        raise
+                    # the call computing it was cancelled, compute it in the next iteration
+
+        selected = [rows[i] for i in idx_range]
+        return cls([EvalTuple(*r[:3]) for r in selected], [r[3] for r in selected], [r[4] for r in selected])
+
+    @classmethod
+    async def _compute_rows(
+        cls,
+        file: Path,
+        split: Literal["train", "val"],
+        idxs: list[int],
+        ref_model: Optional[OpenAIChatModel],
+        gen_model: OpenAIChatModel,
+        gold_labeler: OpenAIChatModel,
+    ) -> dict[int, list]:
+        """Compute the rows, publishing them to concurrent calls, and merge them into the on-disk store."""
+        in_flight = _row_futures[str(file)]
+        futs = {i: asyncio.get_running_loop().create_future() for i in idxs}
+        for fut in futs.values():
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())  # failures are raised to this caller
+        in_flight |= futs
+        try:
+            new = await cls._from_alpaca(split, idxs, ref_model, gen_model, gold_labeler)
+            computed = {
+                i: [*t, label, is_ref]
+                for i, t, label, is_ref in zip(idxs, new.eval_tuples, new.labels, new.output_1_is_ref)
+            }
+            # other calls, or sweep worker processes, may have saved rows since this one loaded the file
+            async with _ds_locks.setdefault(str(file), asyncio.Lock()):
+                file.parent.mkdir(parents=True, exist_ok=True)
+                lease = Lease(file.parent, f"{file.name}.lock", ttl=60)
+                while not await asyncio.to_thread(lease.acquire):
+                    await asyncio.sleep(0.05)
+                try:
+                    save_cached_rows(file, load_cached_rows(file) | computed)
+                finally:
+                    lease.release()
+            for i, fut in futs.items():
+                fut.set_result(computed[i])
+            return computed
+        except BaseException as e:
+            for fut in futs.values():
+                if isinstance(e, asyncio.CancelledError):
+                    fut.cancel()  # waiters compute the rows themselves
+                else:
+                    fut.set_exception(e)
+            raise
+        finally:
+            for i in idxs:
+                in_flight.pop(i, None)
+
+    @classmethod
+    async def _from_alpaca(
+        cls,
+        split: Literal["train", "val"],
+        idxs: list[int],
+        ref_model: Optional[OpenAIChatModel],
+        gen_model: OpenAIChatModel,
+        gold_labeler: OpenAIChatModel,
     ):
-        if split == "train":
-            ds = load_dataset("tatsu-lab/alpaca")["train"]
-            ds = ds.map(lambda e: {**e, "instruction": f"{e['instruction']}\n\n{e['input']}"})
-        elif split == "val":
-            ds = load_dataset("tatsu-lab/alpaca_eval")["eval"]
-        else:
-            raise ValueError(f"{split=} not supported")
-        ds = ds.select(idx_range)
+        instructions, outputs = alpaca_columns(split)
+        ds = [{"instruction": instructions[i], "output": outputs[i]} for i in idxs]
 
         async def get_eval_tuple(e) -> tuple[EvalTuple, bool]:
             generated = (await call_llm(gen_model, [("user", e["instruction"])]))[0].completion
@@ -49,36 +244,103 @@ class ComparisonDs:
         eval_tuples = [e[0] for e in eval_tuples_and_b]
         output_1_is_ref = [e[1] for e in eval_tuples_and_b]
 
-        async def get_label(t):
-            r = await evaluate_one_side(t, gold_labeler)
-            assert r in [0, 1]
-            return bool(r)
-
-        labels = await gather_tqdm([get_label(t) for t in eval_tuples], f"Getting labels for {split}")
+        labels = await gather_tqdm(
+            [get_gold_label(t, gold_labeler) for t in eval_tuples], f"Getting labels for {split}"
+        )
 
         return cls(eval_tuples, labels, output_1_is_ref)
 
     async def replace_comparison(
         self, replacements: list[str], gold_labeler: OpenAIChatModel = GOLD_LABELER
     ) -> "ComparisonDs":
-        new_eval_tuples = []
-        for r, t, output_1_is_ref in zip(replacements, self.eval_tuples, self.output_1_is_ref):
-            if output_1_is_ref:
-                new_eval_tuples.append(EvalTuple(t.instruction, t.output_1, r))
-            else:
-                new_eval_tuples.append(EvalTuple(t.instruction, r, t.output_2))
+        new_eval_tuples = [
+            replace_generated(t, r, output_1_is_ref)
+            for r, t, output_1_is_ref in zip(replacements, self.eval_tuples, self.output_1_is_ref)
+        ]
+        new_labels = await gather_tqdm([get_gold_label(t, gold_labeler) for t in new_eval_tuples], f"Getting labels")
+        return ComparisonDs(new_eval_tuples, new_labels, self.output_1_is_ref).with_digests_from(
+            self, ["instruction", "output_1_is_ref"]
+        )
+
+    async def relabel(self, new_labels: list[bool]) -> "ComparisonDs":
+        return ComparisonDs(self.eval_tuples, new_labels, self.output_1_is_ref).with_digests_from(
+            self, ["instruction", "output_1", "output_2", "output_1_is_ref"]
+        )
 
-        async def get_label(t):
-            r = await evaluate_one_side(t, gold_labeler)
-            assert r in [0, 1]
-            return bool(r)
+    def __len__(self) -> int:
+        return len(self.eval_tuples)
 
-        new_labels = await gather_tqdm([get_label(t) for t in new_eval_tuples], f"Getting labels")
-        return ComparisonDs(new_eval_tuples, new_labels, self.output_1_is_ref)
+    def select(self, idx: Index) -> "ComparisonDs":
+        """Subset of the rows. Zero-copy for contiguous selections of columnar datasets."""
+        idx = as_index_array(idx, len(self))
+        if isinstance(self.eval_tuples, EvalTupleColumns):
+            return ComparisonDs(
+                self.eval_tuples.select(idx), np.asarray(self.labels)[idx], np.asarray(self.output_1_is_ref)[idx]
+            )
+        idxs = range(len(self))[idx] if isinstance(idx, slice) else idx.tolist()
+        return ComparisonDs(
+            [self.eval_tuples[i] for i in idxs], [self.labels[i] for i in idxs], [self.output_1_is_ref[i] for i in idxs]
+        )
 
-    async def relabel(self, new_labels: list[bool]) -> "ComparisonDs":
-        return ComparisonDs(self.eval_tuples, new_labels, self.output_1_is_ref)
+    def to_columnar(self) -> "ComparisonDs":
+        eval_tuples = self.eval_tuples
+        if not isinstance(eval_tuples, EvalTupleColumns):
+            eval_tuples = EvalTupleColumns.from_tuples(eval_tuples)
+        labels, output_1_is_ref = np.asarray(self.labels, dtype=bool), np.asarray(self.output_1_is_ref, dtype=bool)
+        return ComparisonDs(eval_tuples, labels, output_1_is_ref)
+
+    def save(self, folder: Path):
+        """Save as .npy columns, which load() memory-maps."""
+        folder.mkdir(parents=True, exist_ok=True)
+        ds = self.to_columnar()
+        ds.eval_tuples.save(folder)
+        np.save(folder / "labels.npy", ds.labels)
+        np.save(folder / "output_1_is_ref.npy", ds.output_1_is_ref)
+
+    @classmethod
+    def load(cls, folder: Path, mmap: bool = True) -> "ComparisonDs":
+        mode = "r" if mmap else None
+        return cls(
+            EvalTupleColumns.load(folder, mmap),
+            np.load(folder / "labels.npy", mmap_mode=mode),
+            np.load(folder / "output_1_is_ref.npy", mmap_mode=mode),
+        )
+
+    def as_lists(self) -> "ComparisonDs":
+        return ComparisonDs(
+            [EvalTuple(*t) for t in self.eval_tuples],
+            [bool(x) for x in self.labels],
+            [bool(x) for x in self.output_1_is_ref],
+        )
+
+    def to_json(self) -> dict:
+        ds = self.as_lists()
+        return {"eval_tuples": ds.eval_tuples, "labels": ds.labels, "output_1_is_ref": ds.output_1_is_ref}
+
+    @classmethod
+    def from_json(cls, d: dict) -> "ComparisonDs":
+        return cls([EvalTuple(*t) for t in d["eval_tuples"]], d["labels"], d["output_1_is_ref"])
+
+    def column_digest(self, name: str) -> bytes:
+        """Digest of one column, computed once per instance (datasets are not mutated in place)."""
+        if name not in self._digests:
+            if name in EvalTuple._fields:
+                if isinstance(self.eval_tuples, EvalTupleColumns):
+                    self._digests[name] = str_column_digest(getattr(self.eval_tuples, name))
+                else:
+                    self._digests[name] = str_column_digest([getattr(t, name) for t in self.eval_tuples])
+            else:
+                self._digests[name] = bool_column_digest(getattr(self, name))
+        return self._digests[name]
+
+    def with_digests_from(self, other: "ComparisonDs", names: list[str]) -> "ComparisonDs":
+        """Reuse the digests of the columns shared with other."""
+        self._digests.update({k: v for k, v in other._digests.items() if k in names})
+        return self
 
     def hash(self):
-        """Hash with sha256"""
-        return hashlib.sha256(str(self).encode()).hexdigest()
+        """Hash with sha256, streamed field by field, so it doesn't depend on the storage or on repr formatting."""
+        h = hashlib.sha256(HASH_VERSION)
+        for name in HASHED_COLUMNS:
+            h.update(self.column_digest(name))
+        return h.hexdigest()
@@ -1,12 +1,13 @@
 from functools import cache
-from pathlib import Path
+import asyncio
 import random
-from typing import NamedTuple
-from lowstakes.llm import call_llm, Role, OpenAIChatModel
-import json
-from lowstakes.utils import AndMetadata
-from py import log
+from typing import NamedTuple, Optional
+from lowstakes.llm import Role, OpenAIChatModel
+from cpoison.llm_calls import UnexpectedResponseError, call_llm
+from lowstakes.utils import AndMetadata, Metadata
 from cpoison.base_models import DirectModel, Model
+from cpoison.codec import Template, parse_batch_ranking, parse_ranking
+from cpoison.event_log import event_log, log_event
 
 ANSWER_TEMPLATE = """[
     {'model': "model_1", 'rank': {rank_1}},
@@ -43,21 +44,78 @@ Now please rank the models by the quality of their answers, so that the model wi
 Your response must be a valid Python dictionary and should contain nothing else because we will directly execute it in Python. Please provide the ranking that the majority of humans would give.
 """
 
+SCORE_INPUT_TEMPLATE = (
+    INPUT_TEMPLATE.split("Now please rank")[0]
+    + """Now please tell which model has the best output, as the majority of humans would judge it. Answer with a single digit: 1 if model_1 has the best output, 2 if model_2 has the best output. Your answer should contain nothing else.
+"""
+)
+
+BATCH_INPUT_TEMPLATE = """I want you to create a leaderboard of different of large-language models. To do so, I will give you several comparisons, each made of the instruction (prompt) given to the models and the responses of two models. For each comparison, please rank the models based on which responses would be preferred by humans. All inputs and outputs should be python dictionaries.
+
+{comparisons}
+
+Now, for each comparison, please tell which model has the best output. Then return a list with one entry per comparison, i.e., produce the following output:
+[
+    {'comparison': 1, 'best': <model-name>},
+    {'comparison': 2, 'best': <model-name>},
+    ...
+]
+
+Your response must be a valid Python list and should contain nothing else because we will directly execute it in Python. Please provide the rankings that the majority of humans would give.
+"""
+BATCH_ITEM_TEMPLATE = """# Comparison {i}
+
+Here is the prompt:
+{
+    "instruction": \"\"\"{instruction}\"\"\",
+}
+
+Here are the outputs of the models:
+[
+    {
+        "model": "model_1",
+        "answer": \"\"\"{output_1}\"\"\"
+    },
+    {
+        "model": "model_2",
+        "answer": \"\"\"{output_2}\"\"\"
+    }
+]"""
+
+
+TUPLE_FIELDS = ["instruction", "output_1", "output_2"]
+INPUT = Template.compile(INPUT_TEMPLATE, TUPLE_FIELDS)
+SCORE_INPUT = Template.compile(SCORE_INPUT_TEMPLATE, TUPLE_FIELDS)
+BATCH_INPUT = Template.compile(BATCH_INPUT_TEMPLATE, ["comparisons"])
+BATCH_ITEM = Template.compile(BATCH_ITEM_TEMPLATE, ["i"] + TUPLE_FIELDS)
+ANSWER = Template.compile(ANSWER_TEMPLATE, ["rank_1", "rank_2"])
+ANSWERS = {True: ANSWER.render("1", "2"), False: ANSWER.render("2", "1")}
+
+
+class EvalTuple(NamedTuple):
+    instruction: str
+    output_1: str
+    output_2: str
+
 
 def get_messages(instruction: str, output_1: str, output_2: str) -> list[tuple[Role, str]]:
     """Returns a list of messages to send to the API."""
-    input = (
-        INPUT_TEMPLATE.replace("{instruction}", instruction)
-        .replace("{output_1}", output_1)
-        .replace("{output_2}", output_2)
-    )
+    return [("system", INSTRUCTION), ("user", INPUT.render(instruction, output_1, output_2))]
 
-    return [("system", INSTRUCTION), ("user", input)]
+
+def get_score_messages(instruction: str, output_1: str, output_2: str) -> list[tuple[Role, str]]:
+    """Messages asking for a single digit answer, whose first token probabilities give the confidence."""
+    return [("system", INSTRUCTION), ("user", SCORE_INPUT.render(instruction, output_1, output_2))]
+
+
+def get_batch_messages(ts: list[EvalTuple]) -> list[tuple[Role, str]]:
+    """Messages asking for the best model of each of the comparisons ts, numbered from 1."""
+    comparisons = "\n\n".join(BATCH_ITEM.render(str(i + 1), *t) for i, t in enumerate(ts))
+    return [("system", INSTRUCTION), ("user", BATCH_INPUT.render(comparisons))]
 
 
 def get_answer(output_1_is_best: bool) -> str:
-    rank_1, rank_2 = ("1", "2") if output_1_is_best else ("2", "1")
-    return ANSWER_TEMPLATE.replace("{rank_1}", rank_1).replace("{rank_2}", rank_2)
+    return ANSWERS[output_1_is_best]
 
 
 def get_answer_and_messages(
@@ -71,43 +129,60 @@ def get_answer_and_messages(
     return query + [("assistant", get_answer(output_1_is_best))]
 
 
-class EvalTuple(NamedTuple):
-    instruction: str
-    output_1: str
-    output_2: str
-
-
-log_file = Path(__file__).parent / "log.txt"
-log_file.write_text("")
-
-
-def print_to_log(*args):
-    log_file.open("a").write(" ".join([str(a) for a in args]) + "\n")
-
-
 async def evaluate(t: EvalTuple, model: OpenAIChatModel) -> float:
     """Returns 1.0 if output_1 is always better than output_2, 0 if the opposite.
 
     Average over both directions. Can nan if there is an error.
     """
 
-    r1 = await evaluate_one_side(t, model)
+    r1, r2 = await asyncio.gather(evaluate_one_side(t, model), evaluate_one_side(swap(t), model))
     if is_nan(r1):
         return r1
-    r2 = await evaluate_one_side(EvalTuple(t.instruction, t.output_2, t.output_1), model)
-    return (r1 + r2) / 2
+    # r2 is about the swapped tuple, where output_1 is in second position
+    return (r1 + 1 - r2) / 2
+
+
+def swap(t: EvalTuple) -> EvalTuple:
+    return EvalTuple(t.instruction, t.output_2, t.output_1)
+
+
+def bias_stats(first_wins: list[float]) -> Metadata:
+    """first_wins[i] is the fraction of the two orderings of tuple i in which the first position won."""
+    n = max(len(first_wins), 1)
+    return {
+        "n": len(first_wins),
+        "pref_first": sum(first_wins) / n,
+        "position_bias": sum(first_wins) / n - 0.5,
+        "inconsistent": sum(f != 0.5 for f in first_wins) / n,
+    }
+
+
+async def evaluate_model_symmetric(t: EvalTuple, model: Model) -> AndMetadata[float]:
+    """Judge both orderings concurrently. Returns the debiased score (1.0 if output_1 wins in both orderings,
+    0.5 if the judgment follows the position) and the fraction of orderings in which the first position won."""
+    (r1, _), (r2, _) = await asyncio.gather(evaluate_model(t, model), evaluate_model(swap(t), model))
+    return (r1 + 1 - r2) / 2, {"first_wins": (r1 + r2) / 2}
+
+
+def model_name(model: Model) -> str:
+    name = model.__class__.__name__
+    if isinstance(model, DirectModel):
+        name += ":" + model.llm.model_ids[0]
+    return name
 
 
 async def evaluate_one_side(t: EvalTuple, model: OpenAIChatModel) -> float:
     messages = get_messages(t.instruction, t.output_1, t.output_2)
+    name = model.model_ids[0]
+    event_log.judgments[name] += 1
     try:
         r = await call_llm(model, messages)
     except Exception as e:
-        print_to_log("Error parsing response from API", e)
+        log_event("api_error", name, e)
         return 1.0
     try:
         if not r:
-            print_to_log("Recieved no response from API")
+            log_event("no_response", name)
             return 1.0
         model_1_is_best = is_one_best(r[0].completion)
         if model_1_is_best:
@@ -115,61 +190,109 @@ async def evaluate_one_side(t: EvalTuple, model: OpenAIChatModel) -> float:
         else:
             return 0.0
     except Exception as e:
-        print_to_log("Error parsing response from API", e, r[0].completion)
+        log_event("parse_failure", name, e, completion=r[0].completion)
         return 1.0
 
 
 def is_one_best(s: str) -> bool:
     """Returns True if the first model is better than the second."""
-    response = json.loads(s.replace("'", '"'))
-    model_1_is_best = [r["model"] for r in response if r["rank"] == 1][0] == "model_1"
-    return model_1_is_best
+    r = parse_ranking(s)
+    if r is None:
+        raise ValueError("No unique first-ranked model in answer")
+    return r
+
+
+parse_batch_answer = parse_batch_ranking
 
 
 def extract_eval_tuple(input: str) -> EvalTuple:
     """Extracts the eval tuple from the input string."""
-    parts = input.split('"""')
-    _, instruction, _, output_1, _, output_2, _ = parts
-    return EvalTuple(instruction, output_1, output_2)
+    values = INPUT.parse(input)
+    if values is None:
+        raise ValueError("Input was not rendered from INPUT_TEMPLATE")
+    return EvalTuple(*values)
 
 
 async def evaluate_model(t: EvalTuple, model: Model) -> AndMetadata[bool]:
     [(_, ins), (_, inp)] = get_messages(t.instruction, t.output_1, t.output_2)
+    name = model_name(model)
+    event_log.judgments[name] += 1
     try:
         r, meta = await model.call(ins, inp)
     except Exception as e:
-        print_to_log("Error parsing response from API", e)
+        log_event("api_error", name, e)
         return True, {}
     try:
         return is_one_best(r), meta
     except Exception as e:
-        name = model.__class__.__name__
-        if isinstance(model, DirectModel):
-            name += ":" + model.llm.model_ids[0]
-        print_to_log("Error parsing response from API", e, r, name)
+        log_event("parse_failure", name, e, completion=r)
         return True, {}
 
 
-async def multi_evaluations(t: EvalTuple, model: DirectModel, n: int) -> list[bool]:
+async def evaluate_batch(ts: list[EvalTuple], model: DirectModel) -> list[AndMetadata[bool]]:
+    """Judge all ts in one request, falling back to one request per item for answers that can't be parsed."""
+    [(_, ins), (_, inp)] = get_batch_messages(ts)
+    name = model_name(model)
+    event_log.judgments[name] += len(ts)
+    try:
+        r, _ = await model.call(ins, inp)
+    except Exception as e:
+        log_event("api_error", name, e)
+        parsed = [None] * len(ts)
+    else:
+        parsed = parse_batch_answer(r, len(ts))
+        if n_failed := sum(p is None for p in parsed):
+            # each unparsed item is a parse failure, as for single-item judgments
+            log_event("batch_parse_failure", name, n_failed=n_failed, batch_size=len(ts), completion=r)
+
+    async def get(t: EvalTuple, p: Optional[bool]) -> AndMetadata[bool]:
+        if p is None:
+            r, meta = await evaluate_model(t, model)
+            return r, {**meta, "batch_size": len(ts), "fallback": True}
+        return p, {"batch_size": len(ts)}
+
+    return await asyncio.gather(*[get(t, p) for t, p in zip(ts, parsed)])
+
+
+async def multi_evaluations(t: EvalTuple, model: DirectModel, n: int, offset: int = 0) -> list[bool]:
     default = [True] * n
     [(_, ins), (_, inp)] = get_messages(t.instruction, t.output_1, t.output_2)
+    name = model_name(model)
+    event_log.judgments[name] += n
     try:
-        r = await model.calls(ins, inp, n)
+        r = await model.calls(ins, inp, n, offset=offset)
     except Exception as e:
-        print_to_log("Error parsing response from API", e)
+        log_event("api_error", name, e)
         return default
     res = []
     for x in r:
         try:
             res.append(is_one_best(x))
         except Exception as e:
-            name = model.__class__.__name__
-            if isinstance(model, DirectModel):
-                name += ":" + model.llm.model_ids[0]
-            print_to_log("Error parsing response from API in mul eval", e, x, name)
+            log_event("parse_failure", name, e, completion=x, sampled=True)
             res.append(True)
     return res
 
 
+async def logprob_evaluation(t: EvalTuple, model: DirectModel) -> float:
+    """P(model_1 is best) from the rank token probabilities of a single scored call. 0.5 if it fails."""
+    [(_, ins), (_, inp)] = get_score_messages(t.instruction, t.output_1, t.output_2)
+    name = model_name(model)
+    event_log.judgments[name] += 1
+    try:
+        probs = await model.score(ins, inp)
+    except UnexpectedResponseError:
+        raise
+    except Exception as e:
+        log_event("api_error", name, e)
+        return 0.5
+    p1 = sum(p for tok, p in probs.items() if tok.strip() == "1")
+    p2 = sum(p for tok, p in probs.items() if tok.strip() == "2")
+    if p1 + p2 == 0:
+        log_event("parse_failure", name, top_logprobs=probs)
+        return 0.5
+    return p1 / (p1 + p2)
+
+
 def is_nan(x):
     return x != x
@@ -0,0 +1,87 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Optional
+
+from attrs import define, field
+
+LOG_FOLDER = Path(__file__).parent.parent / "logs"
+
+current_stage: ContextVar[Optional[str]] = ContextVar("current_stage", default=None)
+
+
+@define
+class EventLog:
+    """JSONL event log written by a background thread, one file per process, rotated past max_bytes.
+
+    log() only puts the record on a queue, so it is safe to call from hot async code."""
+
+    folder: Path
+    max_bytes: int = 50 * 1024**2
+    backups: int = 5
+    counts: Counter[str] = field(factory=Counter)
+    judgments: Counter[str] = field(factory=Counter)  # per model
+    parse_failures: Counter[str] = field(factory=Counter)  # per model
+    _queue: queue.SimpleQueue = field(factory=queue.SimpleQueue)
+    _thread: Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> Path:
+        return self.folder / f"events-{os.getpid()}.jsonl"
+
+    def log(self, event: str, model: Optional[str] = None, error: Optional[BaseException] = None, **fields: Any):
+        self.counts[event] += 1
+        if event == "parse_failure":
+            self.parse_failures[str(model)] += 1
+        elif event == "batch_parse_failure":
+            self.parse_failures[str(model)] += fields["n_failed"]
+        record = {"time": time.time(), "event": event, "model": model, "stage": current_stage.get(), **fields}
+        if error is not None:
+            record |= {"error_type": type(error).__name__, "error": str(error)}
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        self._queue.put(record)
+
+    def _write_loop(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        f = self.path.open("a")
+        while (record := self._queue.get()) is not None:
+            f.write(json.dumps(record, default=str) + "\n")
+            if self._queue.empty():
+                f.flush()
+            if f.tell() > self.max_bytes:
+                f.close()
+                self._rotate()
+                f = self.path.open("a")
+        f.close()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if (src := self.path.with_suffix(f".jsonl.{i}")).exists():
+                os.replace(src, self.path.with_suffix(f".jsonl.{i + 1}"))
+        os.replace(self.path, self.path.with_suffix(".jsonl.1"))
+
+    def close(self):
+        """Write pending records and stop the writer thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def parse_failure_rates(self) -> dict[str, float]:
+        return {m: self.parse_failures[m] / max(n, 1) for m, n in self.judgments.items()}
+
+
+event_log = EventLog(LOG_FOLDER)
+
+
+def log_event(event: str, model: Optional[str] = None, error: Optional[BaseException] = None, **fields: Any):
+    event_log.log(event, model=model, error=error, **fields)
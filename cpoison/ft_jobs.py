@@ -0,0 +1,264 @@
+import asyncio
+import itertools
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from pathlib import Path
+from typing import IO, Optional
+
+import openai
+from attrs import define, field
+
+from cpoison.leases import LOCK_FOLDER
+
+FT_REGISTRY_FILE = Path(__file__).parent.parent / ".cache" / "ft_jobs.sqlite"
+
+FAILED_STATUSES = ["failed", "cancelled"]
+
+
+@define
+class FtJob:
+    id: str
+    status: str
+    fine_tuned_model: Optional[str] = None
+    suffix: Optional[str] = None
+    created_at: Optional[float] = None
+
+    def has_name(self, name: str) -> bool:
+        return self.suffix == name or (self.fine_tuned_model is not None and name in self.fine_tuned_model)
+
+
+class FtService(ABC):
+    """The fine-tuning API: file uploads and jobs. Methods are blocking."""
+
+    @abstractmethod
+    def create_file(self, f: IO[bytes]) -> str:
+        ...
+
+    @abstractmethod
+    def create_job(
+        self, training_file: str, validation_file: Optional[str], model: str, suffix: str, n_epochs: int
+    ) -> FtJob:
+        ...
+
+    @abstractmethod
+    def list_jobs(self) -> list[FtJob]:
+        """The most recent jobs."""
+        ...
+
+    @abstractmethod
+    def retrieve_job(self, job_id: str) -> FtJob:
+        ...
+
+
+def _from_openai(obj) -> FtJob:
+    return FtJob(
+        obj["id"], obj["status"], obj.get("fine_tuned_model"), obj.get("user_provided_suffix"), obj.get("created_at")
+    )
+
+
+class OpenAIFtService(FtService):
+    def create_file(self, f: IO[bytes]) -> str:
+        return openai.File.create(file=f, purpose="fine-tune").id
+
+    def create_job(
+        self, training_file: str, validation_file: Optional[str], model: str, suffix: str, n_epochs: int
+    ) -> FtJob:
+        files = {"training_file": training_file} | ({"validation_file": validation_file} if validation_file else {})
+        job = openai.FineTuningJob.create(**files, model=model, suffix=suffix, hyperparameters={"n_epochs": n_epochs})
+        return _from_openai(job)
+
+    def list_jobs(self) -> list[FtJob]:
+        return [_from_openai(obj) for obj in openai.FineTuningJob.list(limit=100)["data"]]
+
+    def retrieve_job(self, job_id: str) -> FtJob:
+        return _from_openai(openai.FineTuningJob.retrieve(job_id))
+
+
+@define
+class LocalFtService(FtService):
+    """In-memory stand-in whose jobs succeed duration seconds after creation, e.g. for tests."""
+
+    duration: float = 0.0
+    prefix: str = ""  # of the ids, to tell apart those of services in different processes
+    files: dict[str, int] = field(factory=dict)  # id -> number of lines
+    jobs: dict[str, tuple[FtJob, str, float]] = field(factory=dict)  # id -> (job, base model, finish time)
+    _ids: itertools.count = field(factory=itertools.count)
+
+    def create_file(self, f: IO[bytes]) -> str:
+        file_id = f"file-{self.prefix}{next(self._ids)}"
+        self.files[file_id] = sum(1 for _ in f)
+        return file_id
+
+    def create_job(
+        self, training_file: str, validation_file: Optional[str], model: str, suffix: str, n_epochs: int
+    ) -> FtJob:
+        assert training_file in self.files and (validation_file is None or validation_file in self.files)
+        job = FtJob(f"ftjob-{self.prefix}{next(self._ids)}", "running", None, suffix, time.time())
+        self.jobs[job.id] = (job, model, time.time() + self.duration)
+        return job
+
+    def retrieve_job(self, job_id: str) -> FtJob:
+        job, model, finish = self.jobs[job_id]
+        if job.status == "running" and time.time() >= finish:
+            job.status, job.fine_tuned_model = "succeeded", f"ft:{model}:local:{job.suffix}:{job.id}"
+        return job
+
+    def list_jobs(self) -> list[FtJob]:
+        return [self.retrieve_job(job_id) for job_id in list(self.jobs)[::-1][:100]]
+
+
+@define
+class JobRegistry:
+    """SQLite record of fine-tuning jobs by name (the model suffix), shared by the processes of a machine."""
+
+    path: Path
+    _conn: sqlite3.Connection = field(init=False)
+
+    def __attrs_post_init__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs "
+            "(name TEXT PRIMARY KEY, dataset_hash TEXT, job_id TEXT, status TEXT, model_id TEXT, updated REAL, "
+            "created_at REAL)"
+        )
+        if "created_at" not in [c[1] for c in self._conn.execute("PRAGMA table_info(jobs)")]:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN created_at REAL")
+
+    def get(self, name: str) -> Optional[FtJob]:
+        row = self._conn.execute(
+            "SELECT job_id, status, model_id, created_at FROM jobs WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else FtJob(*row[:3], name, row[3])
+
+    def put(self, name: str, job: FtJob, dataset_hash: Optional[str] = None):
+        self._conn.execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET "
+            "dataset_hash = COALESCE(excluded.dataset_hash, dataset_hash), job_id = excluded.job_id, "
+            "status = excluded.status, model_id = excluded.model_id, updated = excluded.updated, "
+            "created_at = excluded.created_at",
+            (name, dataset_hash, job.id, job.status, job.fine_tuned_model, time.time(), job.created_at),
+        )
+
+    def by_dataset(self, dataset_hash: str) -> list[tuple[str, FtJob]]:
+        rows = self._conn.execute(
+            "SELECT name, job_id, status, model_id, created_at FROM jobs WHERE dataset_hash = ?", (dataset_hash,)
+        ).fetchall()
+        return [(name, FtJob(*rest[:3], name, rest[3])) for name, *rest in rows]
+
+
+@define
+class FtJobManager:
+    """Waits for fine-tuning jobs with one poller for all of them.
+
+    Each poll is one list call (plus a retrieve for waited jobs too old to be listed), and the poll interval
+    grows from min_interval to max_interval while nothing changes."""
+
+    service: FtService
+    registry: JobRegistry
+    lock_folder: Path = LOCK_FOLDER  # leases of the jobs being created, see oai_ft.train
+    min_interval: float = 5.0
+    max_interval: float = 60.0
+    growth: float = 1.5
+    stats: Counter[str] = field(factory=Counter)
+    _waiters: dict[str, list[asyncio.Future]] = field(factory=dict)
+    _poller: Optional[asyncio.Task] = None
+    _interval: float = 0.0
+
+    def register(self, name: str, job: FtJob, dataset_hash: Optional[str] = None):
+        self.registry.put(name, job, dataset_hash)
+
+    async def find_model(self, name: str) -> Optional[str]:
+        """The id of the fine-tuned model with this name, if one has been trained, from the registry or the API."""
+        if (job := self.registry.get(name)) is None or job.fine_tuned_model is None:
+            await self.refresh([name])
+            job = self.registry.get(name)
+        return None if job is None else job.fine_tuned_model
+
+    async def wait(self, name: str) -> str:
+        """The id of the model trained by the job with this name, once it succeeds. Raises if it fails."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(name, []).append(fut)
+        self._resolve()
+        self._interval = self.min_interval
+        if self._poller is None or self._poller.done() or self._poller.get_loop() is not asyncio.get_running_loop():
+            self._poller = asyncio.ensure_future(self._poll())
+        return await fut
+
+    async def refresh(self, names: list[str] = []) -> bool:
+        """Update the registry from the API. Returns whether any waited job changed."""
+        names = list(self._waiters) + names
+        before = {name: self.registry.get(name) for name in self._waiters}
+        self.stats["list_calls"] += 1
+        jobs = await asyncio.to_thread(self.service.list_jobs)  # newest first
+        listed = {job.id: job for job in jobs}
+        seen: set[str] = set()
+        for job in jobs:
+            name = job.suffix or next((n for n in names if job.has_name(n)), None)
+            if name is None:
+                continue
+            if (old := self.registry.get(name)) is None or _replaces(job, old, name not in seen, listed):
+                self.registry.put(name, job)
+            seen.add(name)
+        for name, job in before.items():
+            if job is not None and job.id not in listed and job.status not in ["succeeded"] + FAILED_STATUSES:
+                self.stats["retrieve_calls"] += 1
+                self.registry.put(name, await asyncio.to_thread(self.service.retrieve_job, job.id))
+        return any(self.registry.get(name) != job for name, job in before.items())
+
+    def _resolve(self):
+        for name in list(self._waiters):
+            job = self.registry.get(name)
+            if job is None or (job.fine_tuned_model is None and job.status not in FAILED_STATUSES):
+                continue
+            for fut in self._waiters.pop(name):
+                if fut.done():
+                    continue
+                if job.fine_tuned_model is not None:
+                    fut.set_result(job.fine_tuned_model)
+                else:
+                    fut.set_exception(RuntimeError(f"Fine-tuning job {job.id} for {name} {job.status}"))
+
+    async def _poll(self):
+        while self._waiters:
+            await asyncio.sleep(self._interval)
+            try:
+                changed = await self.refresh()
+            except Exception as e:
+                print(f"Failed to poll fine-tuning jobs: {e!r}")
+                changed = False
+            self._resolve()
+            self._waiters = {n: fs for n, fs in self._waiters.items() if not all(f.done() for f in fs)}
+            self._interval = self.min_interval if changed else min(self._interval * self.growth, self.max_interval)
+
+
+def _replaces(job: FtJob, old: FtJob, newest_listed: bool, listed: dict[str, FtJob]) -> bool:
+    """Whether the listed job should replace the record old of the same name: a succeeded job is kept over any other
+    attempt, and otherwise only the newest attempt is kept, so that an older failure never hides a running retry."""
+    if job.id == old.id:
+        return True
+    if old.fine_tuned_model is not None or job.fine_tuned_model is not None:
+        return old.fine_tuned_model is None
+    if not newest_listed:
+        return False
+    if old.id in listed:  # listed after job, so older
+        return True
+    return job.created_at is not None and old.created_at is not None and job.created_at > old.created_at
+
+
+_ft_manager: Optional[FtJobManager] = None
+
+
+def get_ft_manager() -> FtJobManager:
+    global _ft_manager
+    if _ft_manager is None:
+        _ft_manager = FtJobManager(OpenAIFtService(), JobRegistry(FT_REGISTRY_FILE))
+    return _ft_manager
+
+
+def set_ft_manager(manager: FtJobManager):
+    global _ft_manager
+    _ft_manager = manager
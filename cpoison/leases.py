@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Optional
+
+from attrs import define, field
+
+LOCK_FOLDER = Path(__file__).parent.parent / ".locks"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _create(path: Path, content: dict[str, Any]) -> bool:
+    """Atomically create path with content, False if it already exists. O_EXCL creation is atomic on NFS v3+."""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        json.dump(content, f)
+    return True
+
+
+@define
+class Lease:
+    """Exclusive claim on name, shared between the processes and machines which see folder.
+
+    The holder must heartbeat() more often than every ttl seconds. A lease whose heartbeat is older than ttl, or whose
+    owner process died on this host, is stale and can be taken over by the next acquire()."""
+
+    folder: Path
+    name: str
+    ttl: float = 300.0
+    owner: str = field(factory=lambda: f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+
+    @property
+    def path(self) -> Path:
+        return self.folder / self.name
+
+    def holder(self) -> Optional[dict[str, Any]]:
+        """Content of the lease file (owner, host, pid, acquired, and data set with update), None if free."""
+        try:
+            return json.loads(self.path.read_text()) | {"heartbeat": self.path.stat().st_mtime}
+        except (FileNotFoundError, json.JSONDecodeError):
+            # a lease being created is briefly empty
+            return None if not self.path.exists() else {"heartbeat": time.time()}
+
+    def is_stale(self, holder: dict[str, Any]) -> bool:
+        if time.time() - holder["heartbeat"] > self.ttl:
+            return True
+        return holder.get("host") == socket.gethostname() and not _pid_alive(holder.get("pid", os.getpid()))
+
+    def owned(self) -> bool:
+        return (h := self.holder()) is not None and h.get("owner") == self.owner
+
+    def acquire(self) -> bool:
+        """Try to take the lease, taking over a stale one. Returns whether this owner now holds it."""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        content = {"owner": self.owner, "host": socket.gethostname(), "pid": os.getpid(), "acquired": time.time()}
+        if _create(self.path, content):
+            return True
+        if (h := self.holder()) is None or self.is_stale(h):
+            # only one process at a time may break the stale lease, or a slow one could delete a fresh lease
+            breaker = self.path.with_name(self.path.name + ".breaking")
+            if not _create(breaker, content):
+                try:
+                    if time.time() - breaker.stat().st_mtime > self.ttl:
+                        breaker.unlink(missing_ok=True)
+                except FileNotFoundError:
+                    pass
+                return False
+            try:
+                if (h := self.holder()) is None or self.is_stale(h):
+                    print(f"Taking over stale lease {self.name} from {h}")
+                    self.path.unlink(missing_ok=True)
+                    return _create(self.path, content)
+            finally:
+                breaker.unlink(missing_ok=True)
+        return self.owned()
+
+    def heartbeat(self) -> bool:
+        """Refresh the lease. Returns False if it was lost to another owner."""
+        if not self.owned():
+            return False
+        os.utime(self.path)
+        return True
+
+    def update(self, **data: Any):
+        """Record data (e.g. a job id) in the lease file for other processes to see."""
+        assert (h := self.holder()) is not None and h.get("owner") == self.owner, f"lease {self.name} not held"
+        tmp = self.path.with_name(f"{self.path.name}.{self.owner}.tmp")
+        tmp.write_text(json.dumps({k: v for k, v in h.items() if k != "heartbeat"} | data))
+        os.replace(tmp, self.path)
+
+    def release(self):
+        if self.owned():
+            self.path.unlink(missing_ok=True)
+
+    @asynccontextmanager
+    async def held(self):
+        """Heartbeat in the background while the block runs, then release."""
+
+        async def beat():
+            while True:
+                await asyncio.sleep(self.ttl / 3)
+                if not await asyncio.to_thread(self.heartbeat):
+                    print(f"Lost lease {self.name}")
+                    return
+
+        task = asyncio.ensure_future(beat())
+        try:
+            yield self
+        finally:
+            task.cancel()
+            self.release()
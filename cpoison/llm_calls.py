@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from collections import Counter
+from math import exp
+from typing import Any, Awaitable, Callable, Optional
+
+from attrs import define
+from lowstakes.llm import OpenAIChatModel, Role
+from lowstakes.llm import call_llm as raw_call_llm
+
+from cpoison.response_cache import ResponseCache, get_response_cache
+from cpoison.scheduler import estimate_tokens, scheduler
+
+_in_flight: dict[tuple[str, bool], asyncio.Future] = {}  # by (key, use_cache)
+call_stats: Counter[str] = Counter()
+
+
+class UnexpectedResponseError(Exception):
+    """A response in a format this code doesn't know, which is a bug rather than a transient API error."""
+
+
+class Backend(ABC):
+    @abstractmethod
+    async def call(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], **kwargs) -> list[Any]:
+        """Completions, each with a .completion attribute, like lowstakes' call_llm."""
+        ...
+
+    @abstractmethod
+    async def top_logprobs(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], k: int) -> dict[str, float]:
+        """Logprobs of the k most likely first tokens of the answer."""
+        ...
+
+
+class OpenAIBackend(Backend):
+    async def call(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], **kwargs) -> list[Any]:
+        return await raw_call_llm(llm, messages, **kwargs)
+
+    async def top_logprobs(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], k: int) -> dict[str, float]:
+        """Through lowstakes like other calls, for its retries and API keys. Its responses hold the requested logprobs
+        as one {token: logprob} dict per generated token; anything else raises UnexpectedResponseError, since scoring
+        every item 0.5 would silently send all of them to the untrusted model."""
+        r = await raw_call_llm(llm, messages, max_tokens=1, temperature=0, logprobs=True, top_logprobs=k)
+        logprobs = getattr(r[0], "logprobs", None) if r else None
+        if not isinstance(logprobs, list) or not logprobs or not isinstance(logprobs[0], dict):
+            raise UnexpectedResponseError(f"expected a list of {{token: logprob}} dicts, got {logprobs!r}")
+        return {str(token): float(logprob) for token, logprob in logprobs[0].items()}
+
+
+@define
+class Completion:
+    completion: str
+
+
+@define
+class FnBackend(Backend):
+    """Local stand-in answering every request with fn(messages), e.g. for tests."""
+
+    fn: Callable[[list[tuple[Role, str]]], str]
+
+    async def call(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], n: int = 1, **kwargs) -> list[Any]:
+        return [Completion(self.fn(messages)) for _ in range(n)]
+
+    async def top_logprobs(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], k: int) -> dict[str, float]:
+        return {self.fn(messages)[:1]: 0.0}
+
+
+_backend: Backend = OpenAIBackend()
+
+
+def get_backend() -> Backend:
+    return _backend
+
+
+def set_backend(backend: Backend):
+    global _backend
+    _backend = backend
+
+
+def call_key(llm: OpenAIChatModel, messages: list[tuple[Role, str]], **kwargs) -> str:
+    return hashlib.sha256(json.dumps([llm.model_ids, messages, kwargs], sort_keys=True).encode()).hexdigest()
+
+
+async def call_llm(
+    llm: OpenAIChatModel,
+    messages: list[tuple[Role, str]],
+    use_cache: bool = True,
+    cache_salt: Optional[str] = None,
+    **kwargs,
+):
+    """Drop-in for lowstakes' call_llm where concurrent identical requests share one network call.
+
+    Responses are also read from and written to the on-disk response cache unless use_cache=False.
+    cache_salt distinguishes otherwise identical requests, e.g. successive batches of samples."""
+    salt = {} if cache_salt is None else {"salt": cache_salt}
+    tokens = estimate_tokens(messages, kwargs.get("n", 1))
+    return await _shared_call(
+        call_key(llm, messages, **salt, **kwargs),
+        use_cache,
+        lambda: scheduler.run(llm.model_ids[0], tokens, lambda: get_backend().call(llm, messages, **kwargs)),
+    )
+
+
+async def score_llm(
+    llm: OpenAIChatModel, messages: list[tuple[Role, str]], k: int = 5, use_cache: bool = True
+) -> dict[str, float]:
+    """Probabilities of the k most likely first tokens of the answer, from a single 1-token request."""
+    tokens = estimate_tokens(messages, 0) + 1
+    logprobs = await _shared_call(
+        call_key(llm, messages, top_logprobs=k),
+        use_cache,
+        lambda: scheduler.run(llm.model_ids[0], tokens, lambda: get_backend().top_logprobs(llm, messages, k)),
+    )
+    return {token: exp(logprob) for token, logprob in logprobs.items()}
+
+
+async def _shared_call(key: str, use_cache: bool, fetch: Callable[[], Awaitable[Any]]):
+    call_stats["calls"] += 1
+    cache = get_response_cache() if use_cache else None
+    if cache is not None and (cached := cache.get(key)) is not None:
+        call_stats["cached"] += 1
+        return cached
+    # callers with use_cache=False only share calls between themselves, which are not written to the cache
+    flight_key = (key, use_cache)
+    if flight_key in _in_flight:
+        call_stats["coalesced"] += 1
+    else:
+        call_stats["network"] += 1
+        fut = asyncio.ensure_future(_fetch(key, fetch, cache))
+        _in_flight[flight_key] = fut
+        fut.add_done_callback(lambda _: _in_flight.pop(flight_key, None))
+    # shield so that a cancelled waiter doesn't cancel the call for the others
+    return await asyncio.shield(_in_flight[flight_key])
+
+
+async def _fetch(key: str, fetch: Callable[[], Awaitable[Any]], cache: Optional[ResponseCache]):
+    r = await fetch()
+    if r and cache is not None:
+        cache.put(key, r)
+    return r
+
+
+def coalesce_rate() -> float:
+    return call_stats["coalesced"] / max(call_stats["calls"], 1)
@@ -1,15 +1,22 @@
+import asyncio
 import hashlib
 from typing import TypedDict
 
 from numpy import short
-from cpoison.eval import EvalTuple
+from cpoison.eval import EvalTuple, bias_stats
 from cpoison.oai_ft import train
 from cpoison.protocols import Protocol
 from cpoison.redteams import Redteam
-from cpoison.data import ComparisonDs
+from cpoison.data import ComparisonDs, get_gold_label, replace_generated
 from lowstakes.utils import gather_tqdm, Metadata
-from cpoison.annotators import get_simple_annotator
-from cpoison.base_models import DirectModel
+from cpoison.annotators import Annotator, get_simple_annotator, get_symmetric_annotator
+from cpoison.base_models import DirectModel, Model
+from cpoison.columns import str_columns
+from cpoison.config import GOLD_LABELER
+from cpoison.scheduler import EXPLOIT_PRIORITY, priority
+from cpoison.stages import Stage, checkpointed, run_dag
+from cpoison.streams import collect, stream_map
+from lowstakes.llm import OpenAIChatModel
 
 VERSION = "0.3"
 
@@ -29,32 +36,30 @@ class GenData(TypedDict):
     version: str
 
 
-async def gen_labels(protocol: Protocol, redteam: Redteam, n_supervised: int = 200, n_unsupervised: int = 400):
-    unsupervised = await ComparisonDs.from_alpaca("train", range(n_unsupervised))
-    supervised = await ComparisonDs.from_alpaca("val", range(n_supervised))
+async def label_datasets(n_supervised: int = 200, n_unsupervised: int = 400) -> tuple[ComparisonDs, ComparisonDs]:
+    """The (supervised, unsupervised) datasets of gen_labels."""
+    return await asyncio.gather(
+        ComparisonDs.from_alpaca("val", range(n_supervised)), ComparisonDs.from_alpaca("train", range(n_unsupervised))
+    )
+
 
+async def gen_labels(protocol: Protocol, redteam: Redteam, supervised: ComparisonDs, unsupervised: ComparisonDs):
     untrusted, rt_meta = redteam.get_model(supervised, unsupervised, protocol.info)
     annotator, bt_meta = protocol.get_annotator(supervised, unsupervised.eval_tuples, untrusted)
 
-    annotations_and_meta = await gather_tqdm(
-        [annotator(t) for t in unsupervised.eval_tuples], "Annotating unsupervised"
+    annotations_and_meta, (cue_amounts_1, cue_amounts_2) = await asyncio.gather(
+        gather_tqdm([annotator(t) for t in unsupervised.eval_tuples], "Annotating unsupervised"),
+        redteam.tuple_cue_amounts(unsupervised.eval_tuples),
     )
     annotations, an_meta = [a[0] for a in annotations_and_meta], [a[1] for a in annotations_and_meta]
 
-    cue_amounts_1 = await gather_tqdm(
-        [redteam.cue_amount(t.instruction, t.output_1) for t in unsupervised.eval_tuples], "Getting cue amounts 1"
-    )
-    cue_amounts_2 = await gather_tqdm(
-        [redteam.cue_amount(t.instruction, t.output_2) for t in unsupervised.eval_tuples], "Getting cue amounts 2"
-    )
-
     return GenData(
         protocol=protocol.info,
         redteam=redteam.info,
         labels=unsupervised.labels,
         annotations=annotations,
-        cue_amounts_1=cue_amounts_1,
-        cue_amounts_2=cue_amounts_2,
+        cue_amounts_1=cue_amounts_1.tolist(),
+        cue_amounts_2=cue_amounts_2.tolist(),
         eval_tuples=unsupervised.eval_tuples,
         output_1_is_ref=unsupervised.output_1_is_ref,
         rt_meta=rt_meta,
@@ -86,74 +91,176 @@ class GenFtData(TypedDict):
     post_an_meta: list[Metadata]
     post_exp_annotations: list[bool]
     post_exp_an_meta: list[Metadata]
+    stage_times: dict[str, float]
+    position_bias: dict[str, Metadata]
     version: str
 
 
+def decode_gen_data(d: dict) -> GenData:
+    return GenData(**{**d, "eval_tuples": [EvalTuple(*t) for t in d["eval_tuples"]]})
+
+
 async def gen_and_ft(
     protocol: Protocol,
     redteam: Redteam,
     n_supervised: int = 200,
     n_unsupervised: int = 400,
     n_supervised_test: int = 200,
+    symmetric_eval: bool = False,
 ):
-    gen_data = await gen_labels(protocol, redteam, n_supervised, n_unsupervised)
+    """Runs the stages as a DAG, independent ones concurrently.
 
-    test_ds = await ComparisonDs.from_alpaca("val", range(n_supervised, n_supervised + n_supervised_test))
+    Each stage is checkpointed under a key derived from its inputs, so reruns resume where they stopped.
+    If symmetric_eval, test annotations judge both orderings, and position bias stats are reported."""
 
-    exp_and_meta = await gather_tqdm(
-        [redteam.exploit(t.instruction) for t in test_ds.eval_tuples], "Generating exploits"
-    )
-    exploits, exp_meta = [e[0] for e in exp_and_meta], [e[1] for e in exp_and_meta]
+    def get_annotator(model: Model) -> Annotator:
+        return get_symmetric_annotator(model) if symmetric_eval else get_simple_annotator(model)
 
-    cues_amounts_e = await gather_tqdm(
-        [redteam.cue_amount(t.instruction, e) for t, e in zip(test_ds.eval_tuples, exploits)], "Getting cue amounts e"
-    )
-    cues_amounts_1 = await gather_tqdm(
-        [redteam.cue_amount(t.instruction, t.output_1) for t in test_ds.eval_tuples], "Getting cue amounts 1"
-    )
-    cues_amounts_2 = await gather_tqdm(
-        [redteam.cue_amount(t.instruction, t.output_2) for t in test_ds.eval_tuples], "Getting cue amounts 2"
-    )
+    trusted = DirectModel.trusted()
+    base_model = trusted.llm.model_ids[0]
+    # part of every stage key, so that changing a model never reuses the outputs of the previous one
+    models = [trusted.llm.model_ids, DirectModel.untrusted().llm.model_ids, GOLD_LABELER.model_ids]
 
-    exp_test_ds = await test_ds.replace_comparison(exploits)
+    async def get_gen_data():
+        supervised, unsupervised = await label_datasets(n_supervised, n_unsupervised)
+        return await checkpointed(
+            "gen_labels",
+            [protocol.info, redteam.info, supervised.hash(), unsupervised.hash(), models, VERSION],
+            lambda: gen_labels(protocol, redteam, supervised, unsupervised),
+            decode=decode_gen_data,
+        )
 
-    async def get_annotations(ds, model):
-        annotator = get_simple_annotator(model)
-        an_and_meta = await gather_tqdm([annotator(t) for t in ds.eval_tuples], "Annotating test")
-        return [a[0] for a in an_and_meta], [a[1] for a in an_and_meta]
+    async def get_test_ds():
+        # from_alpaca has its own on-disk store
+        return await ComparisonDs.from_alpaca("val", range(n_supervised, n_supervised + n_supervised_test))
 
-    trusted = DirectModel.trusted()
-    annotations, an_meta = await get_annotations(test_ds, trusted)
-    exp_annotations, exp_an_meta = await get_annotations(exp_test_ds, trusted)
+    async def get_exploits(test_ds: ComparisonDs):
+        """Exploit generation, gold labeling and trusted annotation, streamed item by item."""
+        trusted_annotator = get_annotator(trusted)
 
-    relabel_ds = ComparisonDs(gen_data["eval_tuples"], gen_data["annotations"], gen_data["output_1_is_ref"])
-    ft_id = relabel_ds.hash()[:10]
-    new_model = await train(relabel_ds, f"cp_{ft_id}", val_ds=test_ds, base_model=trusted.llm.model_ids[0])
+        async def exploit(i: int, t: EvalTuple):
+            with priority(EXPLOIT_PRIORITY):
+                return await redteam.exploit(t.instruction)
 
-    post_annotations, post_an_meta = await get_annotations(test_ds, new_model)
-    post_exp_annotations, post_exp_an_meta = await get_annotations(exp_test_ds, new_model)
+        async def label(i: int, exp_and_meta):
+            t = replace_generated(test_ds.eval_tuples[i], exp_and_meta[0], test_ds.output_1_is_ref[i])
+            return exp_and_meta, t, await get_gold_label(t)
+
+        async def annotate(i: int, x):
+            return *x, await trusted_annotator(x[1])
+
+        async def run():
+            s = stream_map(exploit, enumerate(test_ds.eval_tuples))
+            s = stream_map(label, s)
+            s = stream_map(annotate, s)
+            r = await collect(s, len(test_ds.eval_tuples), "Exploit, label and annotate")
+            exp_test_ds = ComparisonDs([x[1] for x in r], [x[2] for x in r], test_ds.output_1_is_ref)
+            return {
+                "exploits": [x[0][0] for x in r],
+                "exp_meta": [x[0][1] for x in r],
+                "exp_test_ds": exp_test_ds.to_json(),
+                "exp_annotations": [x[3][0] for x in r],
+                "exp_an_meta": [x[3][1] for x in r],
+            }
+
+        key = [redteam.info, test_ds.hash(), models, symmetric_eval, VERSION]
+        r = await checkpointed("exploits", key, run)
+        return {**r, "exp_test_ds": ComparisonDs.from_json(r["exp_test_ds"])}
+
+    async def get_cues_test(test_ds: ComparisonDs):
+        async def run():
+            return [a.tolist() for a in await redteam.tuple_cue_amounts(test_ds.eval_tuples)]
+
+        return await checkpointed("cue_amounts", [redteam.info, test_ds.hash(), models, VERSION], run)
+
+    async def get_cues_e(test_ds: ComparisonDs, exploits):
+        async def run():
+            instructions, _, _ = str_columns(test_ds.eval_tuples)
+            return (await redteam.cue_amounts(instructions, exploits["exploits"])).tolist()
+
+        key = [redteam.info, test_ds.hash(), exploits["exploits"], models, VERSION]
+        return await checkpointed("cue_amounts_e", key, run)
+
+    async def get_annotations(name: str, ds: ComparisonDs, model: DirectModel):
+        async def run():
+            annotator = get_annotator(model)
+            an_and_meta = await gather_tqdm([annotator(t) for t in ds.eval_tuples], "Annotating test")
+            return [a[0] for a in an_and_meta], [a[1] for a in an_and_meta]
+
+        return await checkpointed(name, [ds.hash(), model.llm.model_ids, models, symmetric_eval, VERSION], run)
+
+    async def get_new_model(gen_data: GenData, test_ds: ComparisonDs):
+        relabel_ds = ComparisonDs(gen_data["eval_tuples"], gen_data["annotations"], gen_data["output_1_is_ref"])
+        ft_id = relabel_ds.hash()[:10]
+        new_model = await checkpointed(
+            "train",
+            [ft_id, test_ds.hash(), base_model, models],
+            lambda: train(relabel_ds, f"cp_{ft_id}", val_ds=test_ds, base_model=base_model),
+            encode=lambda m: m.llm.model_ids[0],
+            decode=lambda model_id: DirectModel(OpenAIChatModel(model_ids=[model_id])),
+        )
+        return ft_id, new_model
+
+    r, stage_times = await run_dag(
+        {
+            "gen_data": Stage([], get_gen_data),
+            "test_ds": Stage([], get_test_ds),
+            "exploits": Stage(["test_ds"], get_exploits),
+            "cues_test": Stage(["test_ds"], get_cues_test),
+            "cues_e": Stage(["test_ds", "exploits"], get_cues_e),
+            "annotations": Stage(["test_ds"], lambda test_ds: get_annotations("annotations", test_ds, trusted)),
+            "new_model": Stage(["gen_data", "test_ds"], get_new_model),
+            "post_annotations": Stage(
+                ["test_ds", "new_model"],
+                lambda test_ds, new_model: get_annotations("post_annotations", test_ds, new_model[1]),
+            ),
+            "post_exp_annotations": Stage(
+                ["exploits", "new_model"],
+                lambda exploits, new_model: get_annotations(
+                    "post_exp_annotations", exploits["exp_test_ds"], new_model[1]
+                ),
+            ),
+        }
+    )
+    test_ds, exp_test_ds = r["test_ds"], r["exploits"]["exp_test_ds"]
+    cues_amounts_1, cues_amounts_2 = r["cues_test"]
+    ft_id, _ = r["new_model"]
+    annotations, an_meta = r["annotations"]
+    post_annotations, post_an_meta = r["post_annotations"]
+    post_exp_annotations, post_exp_an_meta = r["post_exp_annotations"]
+    an_metas = {
+        "annotations": an_meta,
+        "exp_annotations": r["exploits"]["exp_an_meta"],
+        "post_annotations": post_an_meta,
+        "post_exp_annotations": post_exp_an_meta,
+    }
+    position_bias = (
+        {k: bias_stats([m["first_wins"] for m in metas]) for k, metas in an_metas.items()} if symmetric_eval else {}
+    )
 
     return GenFtData(
         ft_id=ft_id,
         protocol=protocol.info,
         redteam=redteam.info,
-        gen_data=gen_data,
+        gen_data=r["gen_data"],
         eval_tuples=test_ds.eval_tuples,
         labels=test_ds.labels,
         output_1_is_ref=test_ds.output_1_is_ref,
-        exploits=exploits,
-        exp_meta=exp_meta,
+        exploits=r["exploits"]["exploits"],
+        exp_meta=r["exploits"]["exp_meta"],
         exp_labels=exp_test_ds.labels,
-        cues_amounts_e=cues_amounts_e,
+        cues_amounts_e=r["cues_e"],
         cues_amounts_1=cues_amounts_1,
         cues_amounts_2=cues_amounts_2,
         annotations=annotations,
         an_meta=an_meta,
-        exp_annotations=exp_annotations,
-        exp_an_meta=exp_an_meta,
+        exp_annotations=r["exploits"]["exp_annotations"],
+        exp_an_meta=r["exploits"]["exp_an_meta"],
         post_annotations=post_annotations,
         post_an_meta=post_an_meta,
         post_exp_annotations=post_exp_annotations,
         post_exp_an_meta=post_exp_an_meta,
+        stage_times=stage_times,
+        position_bias=position_bias,
         version=VERSION,
     )
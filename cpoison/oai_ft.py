@@ -1,50 +1,73 @@
-from pathlib import Path
-from typing import Optional
-import openai
+from typing import Callable, Iterator, Optional, TypeVar
 import asyncio
-import tempfile
+import io
 import json
+import random
+import time
 from lowstakes.llm import Role, OpenAIChatModel
 
 from cpoison.data import ComparisonDs
 from cpoison.eval import EvalTuple, get_answer_and_messages
 from cpoison.base_models import DirectModel
+from cpoison.ft_jobs import FAILED_STATUSES, FtJobManager, get_ft_manager
+from cpoison.leases import Lease
+from cpoison.scheduler import is_rate_limit_error
 
+T = TypeVar("T")
 
-def try_and_wait(fn):
-    async def f(*args, **kwargs):
-        first = False
-        while True:
+TRANSIENT_ERRORS = ["APIConnectionError", "Timeout", "ServiceUnavailableError", "TryAgain"]
+
+
+def is_transient_error(e: Exception) -> bool:
+    return is_rate_limit_error(e) or type(e).__name__ in TRANSIENT_ERRORS
+
+
+def try_and_wait(fn: Callable[..., T], deadline_s: float = 3600, base_s: float = 1, max_delay_s: float = 120):
+    """Async version of the blocking fn, run in a thread and retried on transient errors.
+
+    Retries wait a random time up to base_s * 2**attempt (capped at max_delay_s), and stop after deadline_s."""
+
+    async def f(*args, **kwargs) -> T:
+        deadline = time.monotonic() + deadline_s
+        for attempt in range(1000):
             try:
-                return fn(*args, **kwargs)
-            except openai.error.RateLimitError as e:
-                if first:
-                    print("Rate limit exceeded, waiting 60s")
-                print(".", end="", flush=True)
-                await asyncio.sleep(60)
+                return await asyncio.to_thread(fn, *args, **kwargs)
+            except Exception as e:
+                delay = random.uniform(0, min(max_delay_s, base_s * 2**attempt))
+                if not is_transient_error(e) or time.monotonic() + delay > deadline:
+                    raise
+                print(f"{type(e).__name__} in {fn.__name__}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+        raise RuntimeError("unreachable")
 
     return f
 
 
-def get_corresponding_models(model_name):
-    return [
-        obj["fine_tuned_model"]
-        for obj in openai.FineTuningJob.list()["data"]
-        if obj["fine_tuned_model"] is not None and model_name in obj["fine_tuned_model"]
-    ]
+def ft_lines(ds: ComparisonDs) -> Iterator[bytes]:
+    for t, label in zip(ds.eval_tuples, ds.labels):
+        l = get_answer_and_messages(t.instruction, t.output_1, t.output_2, output_1_is_best=label)
+        messages = [{"role": r, "content": m} for r, m in l]
+        yield (json.dumps({"messages": messages}) + "\n").encode()
 
 
-def lock_exists(model_name):
-    return (Path(__file__).parent.parent / ".locks" / model_name).exists()
+class JsonlStream(io.RawIOBase):
+    """Read-only file of the fine-tuning JSONL of ds, encoded as it is read rather than written to disk first."""
 
+    def __init__(self, ds: ComparisonDs, name: str):
+        self.name = name
+        self._lines = ft_lines(ds)
+        self._buf = bytearray()
 
-def write_lock(model_name, content):
-    (Path(__file__).parent.parent / ".locks" / model_name).write_text(content)
+    def readable(self) -> bool:
+        return True
 
-
-def remove_lock(model_name):
-    if lock_exists(model_name):
-        (Path(__file__).parent.parent / ".locks" / model_name).unlink()
+    def readinto(self, b) -> int:
+        while len(self._buf) < len(b) and (line := next(self._lines, None)) is not None:
+            self._buf += line
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        del self._buf[:n]
+        return n
 
 
 async def train(
@@ -55,47 +78,54 @@ async def train(
     base_model: str = "gpt-3.5-turbo",
 ):
     name = name.replace("_", "-")
-    if get_corresponding_models(name):
+    manager = get_ft_manager()
+    if (model_id := await manager.find_model(name)) is not None:
         print(f"Found existing model {name}, skipping training")
-        return DirectModel(OpenAIChatModel(model_ids=[get_corresponding_models(name)[0]]))
-
-    if lock_exists(name):
-        print(f"Found lock for {name}, waiting...")
-    else:
-        print(f"Training {name} with {len(train_ds.eval_tuples)} datapoints")
-        write_lock(name, "")
-
-        assert len(name) <= 18, f"{name=} is too long (max 18 chars, has {len(name)})"
-
-        files = {"training_file": train_ds} | ({"validation_file": val_ds} if val_ds else {})
-        responses = {}
-
-        for k, v in files.items():
-            with tempfile.NamedTemporaryFile("r+") as f:
-                for t, label in zip(v.eval_tuples, v.labels):
-                    l = get_answer_and_messages(t.instruction, t.output_1, t.output_2, output_1_is_best=label)
-                    messages = [{"role": r, "content": m} for r, m in l]
-                    f.write(json.dumps({"messages": messages}) + "\n")
-                f.flush()
-                # reset file pointer
-                f.seek(0)
-                responses[k] = openai.File.create(file=f, purpose="fine-tune").id
-                print(f"File uploaded successfully. ID: {responses[k]}")
-
-        ft_response = await try_and_wait(openai.FineTuningJob.create)(
-            **responses,
-            model=base_model,
-            suffix=name,
-            hyperparameters={
-                "n_epochs": n_epochs,
-            },
-        )
-        print(f"Fine-tuning job created successfully. ID: {ft_response.id}")
-        write_lock(name, ft_response.id)
-    while True:
-        if get_corresponding_models(name):
-            remove_lock(name)
-            new_model_name = get_corresponding_models(name)[0]
-            return DirectModel(OpenAIChatModel(model_ids=[new_model_name]))
-        await asyncio.sleep(60)
+        return DirectModel(OpenAIChatModel(model_ids=[model_id]))
+
+    # the lease holder trains and waits for the job, others wait for the job and take over if the holder dies
+    lease = Lease(manager.lock_folder, name)
+    waiting = asyncio.ensure_future(manager.wait(name))
+    while not await asyncio.to_thread(lease.acquire):
+        print(f"Found lease for {name} held by {lease.holder()}, waiting...")
+        done, _ = await asyncio.wait([waiting], timeout=lease.ttl / 2)
+        if done:
+            return DirectModel(OpenAIChatModel(model_ids=[waiting.result()]))
+    waiting.cancel()
+
+    async with lease.held():
+        await manager.refresh([name])
+        if (job := manager.registry.get(name)) is None or job.status in FAILED_STATUSES:
+            await create_job(manager, train_ds, name, n_epochs, val_ds, base_model)
+            lease.update(job_id=manager.registry.get(name).id)
         print(f"Waiting for {name} to finish training...")
+        new_model_name = await manager.wait(name)
+    return DirectModel(OpenAIChatModel(model_ids=[new_model_name]))
+
+
+async def create_job(
+    manager: FtJobManager,
+    train_ds: ComparisonDs,
+    name: str,
+    n_epochs: int,
+    val_ds: Optional[ComparisonDs],
+    base_model: str,
+):
+    print(f"Training {name} with {len(train_ds.eval_tuples)} datapoints")
+    assert len(name) <= 18, f"{name=} is too long (max 18 chars, has {len(name)})"
+
+    files = {"training_file": train_ds} | ({"validation_file": val_ds} if val_ds else {})
+
+    def upload(ds: ComparisonDs, k: str) -> str:
+        # a fresh stream per attempt, since a failed upload may have consumed part of it
+        return manager.service.create_file(JsonlStream(ds, f"{name}_{k}.jsonl"))
+
+    file_ids = await asyncio.gather(*(try_and_wait(upload)(v, k) for k, v in files.items()))
+    responses = {"validation_file": None} | dict(zip(files, file_ids))
+    print(f"Files uploaded successfully. IDs: {file_ids}")
+
+    ft_response = await try_and_wait(manager.service.create_job)(
+        **responses, model=base_model, suffix=name, n_epochs=n_epochs
+    )
+    print(f"Fine-tuning job created successfully. ID: {ft_response.id}")
+    manager.register(name, ft_response, train_ds.hash())
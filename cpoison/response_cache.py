@@ -0,0 +1,87 @@
+import pickle
+import sqlite3
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Optional
+
+from attrs import define, field
+
+CACHE_FOLDER = Path(__file__).parent.parent / ".cache"
+
+
+@define
+class ResponseCache:
+    """SQLite store of pickled API responses, evicting least recently used entries past max_bytes."""
+
+    path: Path
+    max_bytes: int = 2 * 1024**3
+    stats: Counter[str] = field(factory=Counter)
+    _conn: sqlite3.Connection = field(init=False)
+    _total_bytes: int = field(init=False)
+
+    def __attrs_post_init__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.stats["hits"] += 1
+        self.stats["bytes_read"] += len(row[0])
+        return pickle.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        blob = pickle.dumps(value)
+        old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, blob, len(blob), time.time()))
+        self._total_bytes += len(blob) - (old[0] if old else 0)
+        self.stats["bytes_written"] += len(blob)
+        if self._total_bytes > self.max_bytes:
+            self.evict(int(self.max_bytes * 0.9))
+
+    def evict(self, target_bytes: int):
+        """Drop least recently used entries until the cache holds at most target_bytes."""
+        while self._total_bytes > target_bytes:
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 256").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_bytes <= target_bytes:
+                    break
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self.stats["evicted"] += 1
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def hit_rate(self) -> float:
+        return self.stats["hits"] / max(self.stats["hits"] + self.stats["misses"], 1)
+
+
+_response_cache: Optional[ResponseCache] = None
+_cache_enabled = True
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _response_cache
+    if _cache_enabled and _response_cache is None:
+        _response_cache = ResponseCache(CACHE_FOLDER / "responses.sqlite")
+    return _response_cache if _cache_enabled else None
+
+
+def set_response_cache(cache: Optional[ResponseCache]):
+    """Replace the process-wide cache. None disables caching."""
+    global _response_cache, _cache_enabled
+    _response_cache, _cache_enabled = cache, cache is not None
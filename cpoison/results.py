@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from attrs import define, field
+
+from cpoison.columns import EvalTupleColumns, StrColumn
+from cpoison.data import str_column_digest
+
+RESULTS_FOLDER = Path(__file__).parent.parent / "data"
+RUN_KEYS = ["protocol", "redteam", "version"]  # shared by a run and its gen_data
+
+
+def column_kind(name: str, values: list) -> str:
+    if name.split(".")[-1] == "eval_tuples":
+        return "tuples"
+    if all(isinstance(v, bool) for v in values):
+        return "bool"
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return "float"
+    if all(isinstance(v, str) for v in values):
+        return "str"
+    return "json"
+
+
+def flatten(result: dict[str, Any]) -> tuple[dict[str, Any], dict[str, list]]:
+    """Split a GenFtData into run-level metadata and per-item columns; gen_data keys are prefixed with "gen_data."
+
+    gen_data's protocol, redteam and version are the run's, so they are not stored again."""
+    meta, columns = {}, {}
+    items = [(k, v) for k, v in result.items() if k != "gen_data"]
+    items += [(f"gen_data.{k}", v) for k, v in result.get("gen_data", {}).items() if k not in RUN_KEYS]
+    for k, v in items:
+        (columns if isinstance(v, list) else meta)[k] = v
+    return meta, columns
+
+
+@define
+class ResultStore:
+    """Sweep results: one small JSON file of metadata per run, with per-item columns stored once by content digest.
+
+    Columns shared between runs (the test set, its labels, ...) are stored once, and loaded memory-mapped. A SQLite
+    index of the runs (rebuilt from runs/ when missing entries) answers queries without reading them."""
+
+    folder: Path = RESULTS_FOLDER
+    _conn: sqlite3.Connection = field(init=False)
+
+    def __attrs_post_init__(self):
+        for sub in ["runs", "columns"]:
+            (self.folder / sub).mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.folder / "index.sqlite", isolation_level=None, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs (id TEXT PRIMARY KEY, version TEXT, protocol TEXT, protocol_full TEXT, "
+            "redteam TEXT, ft_id TEXT, timestamp REAL)"
+        )
+        for col in ["version", "protocol", "protocol_full", "redteam", "ft_id", "timestamp"]:
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS runs_{col} ON runs ({col})")
+        self.refresh()
+
+    def refresh(self):
+        """Index the runs added by other processes or machines."""
+        indexed = {r[0] for r in self._conn.execute("SELECT id FROM runs")}
+        for file in (self.folder / "runs").glob("*.json"):
+            if file.stem not in indexed:
+                self._index(file.stem, json.loads(file.read_text()))
+
+    def _index(self, run_id: str, meta: dict[str, Any]):
+        protocol, redteam = meta.get("protocol", {}), meta.get("redteam", {})
+        self._conn.execute(
+            "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                run_id,
+                meta.get("version"),
+                protocol.get("name"),
+                protocol.get("full_name", protocol.get("name")),
+                redteam.get("name"),
+                meta.get("ft_id"),
+                meta.get("timestamp"),
+            ),
+        )
+
+    def has(self, run_id: str) -> bool:
+        return (self.folder / "runs" / f"{run_id}.json").exists()
+
+    def add(self, result: dict[str, Any], run_id: str, timestamp: Optional[float] = None, **extra: Any):
+        """Store a GenFtData. extra (e.g. the sweep job) is kept in the run metadata."""
+        meta, columns = flatten(result)
+        meta |= extra | {"timestamp": time.time() if timestamp is None else timestamp}
+        meta["columns"] = {name: self._write_column(name, values) for name, values in columns.items()}
+        tmp = self.folder / "runs" / f".{run_id}.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, self.folder / "runs" / f"{run_id}.json")
+        self._index(run_id, meta)
+
+    def _write_column(self, name: str, values: list) -> dict[str, Any]:
+        kind = column_kind(name, values)
+        if kind == "tuples":
+            digests = [self._write_str([t[i] for t in values]) for i in range(3)]
+            return {"kind": kind, "digest": digests}
+        if kind == "str":
+            return {"kind": kind, "digest": self._write_str(values)}
+        if kind == "json":
+            blob = json.dumps(values).encode()
+            digest = hashlib.sha256(blob).hexdigest()
+            self._write_file(f"{digest}.json", lambda f: f.write(blob))
+        else:
+            a = np.asarray(values, dtype=np.bool_ if kind == "bool" else np.float64)
+            digest = hashlib.sha256(kind.encode() + a.tobytes()).hexdigest()
+            self._write_file(f"{digest}.npy", lambda f: np.save(f, a))
+        return {"kind": kind, "digest": digest}
+
+    def _write_str(self, strs: list[str]) -> str:
+        digest = str_column_digest(strs).hex()
+        folder = self.folder / "columns"
+        if not (folder / f"{digest}.offsets.npy").exists():
+            tmp = f"{digest}.{os.getpid()}.tmp"
+            StrColumn.from_strs(strs).save(folder, tmp)
+            # offsets last, since their presence marks the column as written
+            for part in ["data", "offsets"]:
+                os.replace(folder / f"{tmp}.{part}.npy", folder / f"{digest}.{part}.npy")
+        return digest
+
+    def _write_file(self, name: str, write):
+        file = self.folder / "columns" / name
+        if not file.exists():
+            tmp = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+            with tmp.open("wb") as f:
+                write(f)
+            os.replace(tmp, file)
+
+    def ids(
+        self,
+        version: Optional[str] = None,
+        protocol: Optional[str] = None,
+        redteam: Optional[str] = None,
+        ft_id: Optional[str] = None,
+        since: Optional[float] = None,
+    ) -> list[str]:
+        """Ids of the runs matching all the given filters, oldest first. protocol matches the name or full name."""
+        return [r["id"] for r in self.runs(version, protocol, redteam, ft_id, since)]
+
+    def runs(
+        self,
+        version: Optional[str] = None,
+        protocol: Optional[str] = None,
+        redteam: Optional[str] = None,
+        ft_id: Optional[str] = None,
+        since: Optional[float] = None,
+    ) -> list[dict[str, Any]]:
+        """Index rows (id, version, protocol, protocol_full, redteam, ft_id, timestamp) of the runs, like ids()."""
+        where, args = [], []
+        for col, value in [("version", version), ("redteam", redteam), ("ft_id", ft_id)]:
+            if value is not None:
+                where.append(f"{col} = ?")
+                args.append(value)
+        if protocol is not None:
+            where.append("(protocol = ? OR protocol_full = ?)")
+            args += [protocol, protocol]
+        if since is not None:
+            where.append("timestamp >= ?")
+            args.append(since)
+        query = "SELECT * FROM runs" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY timestamp"
+        cursor = self._conn.execute(query, args)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def meta(self, run_id: str) -> dict[str, Any]:
+        return json.loads((self.folder / "runs" / f"{run_id}.json").read_text())
+
+    def load(self, run_id: str, columns: Optional[Iterable[str]] = None) -> dict[str, Any]:
+        """Run metadata and the given columns (default all): numpy arrays for bools and floats, StrColumns for
+        strings, EvalTupleColumns for eval tuples, and lists otherwise."""
+        meta = self.meta(run_id)
+        stored = meta.pop("columns")
+        names = stored.keys() if columns is None else columns
+        return meta | {name: self._read_column(stored[name]) for name in names}
+
+    def _read_column(self, column: dict[str, Any]):
+        folder, kind, digest = self.folder / "columns", column["kind"], column["digest"]
+        if kind == "tuples":
+            return EvalTupleColumns(*(StrColumn.load(folder, d) for d in digest))
+        if kind == "str":
+            return StrColumn.load(folder, digest)
+        if kind == "json":
+            return json.loads((folder / f"{digest}.json").read_text())
+        return np.load(folder / f"{digest}.npy", mmap_mode="r")
+
+    def to_gen_ft_data(self, run_id: str) -> dict[str, Any]:
+        """The run as the GenFtData dict it was added from."""
+        r = self.load(run_id)
+        gen_data = {k: r[k] for k in RUN_KEYS}
+        out = {}
+        for k, v in r.items():
+            if isinstance(v, EvalTupleColumns):
+                v = [list(t) for t in v]
+            elif isinstance(v, (StrColumn, np.ndarray)):
+                v = list(v) if isinstance(v, StrColumn) else v.tolist()
+            if k.startswith("gen_data."):
+                gen_data[k.removeprefix("gen_data.")] = v
+            else:
+                out[k] = v
+        return out | {"gen_data": gen_data}
+
+    def import_json_files(self, folder: Optional[Path] = None):
+        """Add the results saved as <folder>/*.json by earlier sweeps, with the file name as id."""
+        for file in sorted((folder or self.folder).glob("*.json")):
+            if not self.has(file.stem):
+                self.add(json.loads(file.read_text()), file.stem, timestamp=file.stat().st_mtime)
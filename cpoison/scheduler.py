@@ -0,0 +1,186 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from attrs import define, field
+
+from cpoison.config import DEFAULT_RATE_LIMIT, MAX_IN_FLIGHT, RATE_LIMITS
+
+T = TypeVar("T")
+
+# lower runs first
+GOLD_PRIORITY = 0
+DEFAULT_PRIORITY = 5
+EXPLOIT_PRIORITY = 10
+
+COMPLETION_TOKENS_ESTIMATE = 300
+RATE_LIMIT_BACKOFF_S = 5
+
+current_priority: ContextVar[int] = ContextVar("current_priority", default=DEFAULT_PRIORITY)
+
+
+@contextmanager
+def priority(p: int):
+    """Calls issued inside this block (including tasks created in it) are scheduled with priority p."""
+    token = current_priority.set(p)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def estimate_tokens(messages: list[tuple[str, str]], n: int = 1) -> int:
+    return sum(len(m) for _, m in messages) // 4 + n * COMPLETION_TOKENS_ESTIMATE
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    return "RateLimit" in type(e).__name__ or "429" in str(e)
+
+
+@define
+class TokenBucket:
+    per_minute: float
+    level: float = field(init=False)
+    last: float = field(init=False, factory=time.monotonic)
+
+    def __attrs_post_init__(self):
+        self.level = self.per_minute
+
+    def wait_time(self, amount: float) -> float:
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self.last) * self.per_minute / 60)
+        self.last = now
+        # requests bigger than the bucket go through once it is full
+        return max(0.0, (min(amount, self.per_minute) - self.level) * 60 / self.per_minute)
+
+    def take(self, amount: float):
+        self.level -= amount
+
+
+@define
+class ModelQueue:
+    requests: TokenBucket
+    tokens: TokenBucket
+    waiting: list[tuple[int, int, int, asyncio.Future]] = field(factory=list)  # heap of (priority, seq, tokens, fut)
+    in_flight: int = 0
+    stats: Counter[str] = field(factory=Counter)
+
+    def head_wait(self) -> Optional[float]:
+        """Seconds until the first waiting call may start, None if nothing waits."""
+        while self.waiting and self.waiting[0][3].done():  # cancelled while waiting
+            heapq.heappop(self.waiting)
+        if not self.waiting:
+            return None
+        return max(self.requests.wait_time(1), self.tokens.wait_time(self.waiting[0][2]))
+
+
+def get_limits(model_id: str) -> tuple[int, int]:
+    matches = [k for k in RATE_LIMITS if model_id.startswith(k)]
+    return RATE_LIMITS[max(matches, key=len)] if matches else DEFAULT_RATE_LIMIT
+
+
+@define
+class Scheduler:
+    """Shared gate for API calls: per-model token buckets, a global in-flight bound and priorities.
+
+    Waiting calls are started in (priority, arrival) order among those whose model has budget left."""
+
+    max_in_flight: int = MAX_IN_FLIGHT
+    max_rate_limit_retries: int = 5
+    share: float = 1.0  # of the rate limits, for processes which share API keys
+    in_flight: int = 0
+    queues: dict[str, ModelQueue] = field(factory=dict)
+    _seq: itertools.count = field(factory=itertools.count)
+    _timer: Optional[asyncio.TimerHandle] = None
+
+    def _queue(self, model_id: str) -> ModelQueue:
+        if model_id not in self.queues:
+            rpm, tpm = get_limits(model_id)
+            self.queues[model_id] = ModelQueue(TokenBucket(rpm * self.share), TokenBucket(tpm * self.share))
+        return self.queues[model_id]
+
+    def split(self, n: int):
+        """Use 1/n of the rate limits and of the in-flight bound, for each of n processes sharing the API keys."""
+        self.share = 1 / n
+        self.max_in_flight = max(1, MAX_IN_FLIGHT // n)
+        self.queues.clear()
+
+    def _dispatch(self):
+        """Start every call that may run now, and wake up again when the next rate limited one may."""
+        next_wake = None
+        while self.in_flight < self.max_in_flight:
+            ready = []
+            for q in self.queues.values():
+                wait = q.head_wait()
+                if wait == 0:
+                    ready.append(q)
+                elif wait is not None:
+                    next_wake = wait if next_wake is None else min(next_wake, wait)
+            if not ready:
+                break
+            q = min(ready, key=lambda q: q.waiting[0][:2])
+            _, _, tokens, fut = heapq.heappop(q.waiting)
+            q.requests.take(1)
+            q.tokens.take(tokens)
+            q.in_flight += 1
+            self.in_flight += 1
+            q.stats["started"] += 1
+            fut.set_result(None)
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if next_wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._dispatch)
+
+    async def acquire(self, model_id: str, tokens: int, prio: Optional[int] = None):
+        q = self._queue(model_id)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(q.waiting, (current_priority.get() if prio is None else prio, next(self._seq), tokens, fut))
+        q.stats["max_queued"] = max(q.stats["max_queued"], len(q.waiting))
+        start = time.monotonic()
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(model_id)
+            raise
+        q.stats["wait_ms"] += int(1000 * (time.monotonic() - start))
+
+    def release(self, model_id: str):
+        q = self._queue(model_id)
+        q.in_flight -= 1
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def run(self, model_id: str, tokens: int, fn: Callable[[], Awaitable[T]], prio: Optional[int] = None) -> T:
+        """Wait for a slot, then await fn(). Rate limit errors empty the model's buckets and retry."""
+        for attempt in itertools.count():
+            await self.acquire(model_id, tokens, prio)
+            try:
+                return await fn()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_rate_limit_retries:
+                    raise
+                q = self._queue(model_id)
+                q.stats["rate_limited"] += 1
+                for bucket in [q.requests, q.tokens]:
+                    bucket.level = min(bucket.level, -bucket.per_minute * RATE_LIMIT_BACKOFF_S / 60)
+            finally:
+                self.release(model_id)
+        raise AssertionError("unreachable")
+
+    def metrics(self) -> dict[str, dict[str, int]]:
+        return {
+            model_id: {"queued": len(q.waiting), "in_flight": q.in_flight, **q.stats}
+            for model_id, q in self.queues.items()
+        }
+
+
+scheduler = Scheduler()
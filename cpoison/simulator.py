@@ -0,0 +1,281 @@
+"""Deterministic offline stand-in for the OpenAI chat and fine-tuning APIs.
+
+install() routes every API call and all on-disk state of the process to the simulator, so that gen_and_ft and
+sweep.run run without network access. Run a full simulated sweep with python -m cpoison.simulator"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import time
+from collections import Counter, deque
+from functools import partial
+from math import log
+from pathlib import Path
+from typing import IO, Any, Optional
+
+from attrs import define, field
+from lowstakes.llm import OpenAIChatModel, Role
+
+from cpoison import data, stages
+from cpoison.columns import StrColumn
+from cpoison.eval import BATCH_INPUT, BATCH_ITEM, INPUT, SCORE_INPUT, EvalTuple, get_answer
+from cpoison.event_log import event_log
+from cpoison.ft_jobs import FtJob, FtJobManager, JobRegistry, LocalFtService, set_ft_manager
+from cpoison.llm_calls import Backend, Completion, set_backend
+from cpoison.response_cache import ResponseCache, set_response_cache
+
+SIM_FOLDER = Path(__file__).parent.parent / ".cache" / "sim"
+
+WORDS = (
+    "the a model answer result data list value should can will first then because example important step use "
+    "python function output input return make sure note however also which each other more most time way"
+).split()
+
+
+class SimRateLimitError(Exception):
+    pass
+
+
+class ServiceUnavailableError(Exception):
+    """Named like the openai error, so that it is retried as a transient error."""
+
+
+def unit(*parts: Any) -> float:
+    """Deterministic pseudo-random number in [0, 1) from parts."""
+    h = hashlib.sha256(json.dumps(parts, default=str).encode()).digest()
+    return int.from_bytes(h[:8], "little") / 2**64
+
+
+def quality(output: str, length_weight: float) -> float:
+    """Gold quality of an output: a fixed random part plus a length bonus, so that length is a real but weak cue."""
+    return unit("quality", output) + length_weight * min(len(output), 2000) / 2000
+
+
+@define
+class SimBackend(Backend):
+    """Answers generation prompts with random text and judge prompts in the ranking format.
+
+    Judges see the gold preference flipped with a per-model noise probability, and answer model_1 with probability
+    position_bias regardless. Answers depend only on the prompt, the model and the sample index."""
+
+    latency_s: float = 0.05
+    rpm: Optional[int] = None  # server-side requests per minute, beyond which requests fail with a 429
+    error_rate: float = 0.0
+    client_retries: int = 3
+    judge_noise: dict[str, float] = field(factory=lambda: {"gpt-4": 0.05, "gpt-3.5-turbo": 0.2, "ft:": 0.15})
+    default_noise: float = 0.3
+    position_bias: float = 0.05
+    length_weight: float = 0.3
+    seed: int = 0
+    stats: Counter[str] = field(factory=Counter)
+    _samples: Counter[str] = field(factory=Counter)  # sampled completions served per prompt
+    _window: deque = field(factory=deque)  # start times of the requests of the last minute
+    _rng: random.Random = field(init=False)
+
+    def __attrs_post_init__(self):
+        self._rng = random.Random(self.seed)
+
+    def noise(self, model_id: str) -> float:
+        matches = [k for k in self.judge_noise if model_id.startswith(k)]
+        return self.judge_noise[max(matches, key=len)] if matches else self.default_noise
+
+    def p_first(self, model_id: str, t: EvalTuple) -> float:
+        """Probability that the judge model_id says output_1 is best."""
+        gold = quality(t.output_1, self.length_weight) >= quality(t.output_2, self.length_weight)
+        noise = self.noise(model_id)
+        return self.position_bias + (1 - self.position_bias) * (1 - noise if gold else noise)
+
+    def judge(self, model_id: str, t: EvalTuple, sample: int) -> bool:
+        return unit(self.seed, "judge", model_id, *t, sample) < self.p_first(model_id, t)
+
+    def generate(self, model_id: str, prompt: str, sample: int) -> str:
+        rng = random.Random(f"{self.seed}:{model_id}:{sample}:{prompt}")
+        n_words = rng.randint(10, 150)
+        if "long and detailed" in prompt:
+            n_words *= 3
+        elif "short and concise" in prompt:
+            n_words = max(3, n_words // 5)
+        return " ".join(rng.choices(WORDS, k=n_words)).capitalize() + "."
+
+    def complete(self, model_id: str, prompt: str, sample: int) -> str:
+        if (values := INPUT.parse(prompt)) is not None:
+            return get_answer(self.judge(model_id, EvalTuple(*values), sample))
+        if (values := BATCH_INPUT.parse(prompt)) is not None:
+            items = [BATCH_ITEM.parse(c) for c in re.split(r"\n\n(?=# Comparison \d+\n)", values[0])]
+            bests = [(v[0], 1 if self.judge(model_id, EvalTuple(*v[1:]), sample) else 2) for v in items if v]
+            return "[\n" + ",\n".join(f"    {{'comparison': {i}, 'best': 'model_{b}'}}" for i, b in bests) + "\n]"
+        return self.generate(model_id, prompt, sample)
+
+    async def _request(self, kind: str):
+        self.stats[kind] += 1
+        now = time.monotonic()
+        while self._window and self._window[0] < now - 60:
+            self._window.popleft()
+        if self.rpm is not None and len(self._window) >= self.rpm:
+            self.stats["rate_limited"] += 1
+            raise SimRateLimitError("429: simulated rate limit reached")
+        self._window.append(now)
+        # server errors are retried by the client, like lowstakes' call_llm does, so they only add latency
+        for attempt in range(self.client_retries + 1):
+            await asyncio.sleep(self._rng.expovariate(1 / self.latency_s) if self.latency_s > 0 else 0)
+            if self._rng.random() >= self.error_rate:
+                return
+            self.stats["errors"] += 1
+        raise ServiceUnavailableError("simulated server error")
+
+    async def call(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], n: int = 1, **kwargs) -> list[Any]:
+        await self._request("call")
+        prompt = messages[-1][1]
+        if kwargs.get("temperature", 0) > 0:
+            key = json.dumps([llm.model_ids, messages])
+            samples = range(self._samples[key], self._samples[key] + n)
+            self._samples[key] += n
+        else:
+            samples = range(1)
+        completions = [self.complete(llm.model_ids[0], prompt, s) for s in samples]
+        return [Completion(c) for c in completions] * (n if len(samples) == 1 else 1)
+
+    async def top_logprobs(self, llm: OpenAIChatModel, messages: list[tuple[Role, str]], k: int) -> dict[str, float]:
+        await self._request("top_logprobs")
+        if (values := SCORE_INPUT.parse(messages[-1][1])) is None:
+            return {self.generate(llm.model_ids[0], messages[-1][1], 0)[:1]: 0.0}
+        p = self.p_first(llm.model_ids[0], EvalTuple(*values))
+        return {"1": log(p), "2": log(1 - p)}
+
+
+@define
+class SimFtService(LocalFtService):
+    """LocalFtService with API latency, transient errors, and jobs which fail with probability failure_rate.
+
+    Its methods block like the real client, so they should be called from worker threads."""
+
+    duration: float = 5.0
+    latency_s: float = 0.1
+    error_rate: float = 0.0
+    failure_rate: float = 0.0
+    seed: int = 0
+    stats: Counter[str] = field(factory=Counter)
+    failing: set[str] = field(factory=set)
+    _rng: random.Random = field(init=False)
+
+    def __attrs_post_init__(self):
+        self._rng = random.Random(self.seed)
+
+    def _request(self, kind: str):
+        self.stats[kind] += 1
+        time.sleep(self.latency_s)
+        if self._rng.random() < self.error_rate:
+            self.stats["errors"] += 1
+            raise ServiceUnavailableError(f"simulated {kind} error")
+
+    def _job(self, job_id: str) -> FtJob:
+        job, _, finish = self.jobs[job_id]
+        if job_id in self.failing and job.status == "running" and time.time() >= finish:
+            job.status = "failed"
+        return LocalFtService.retrieve_job(self, job_id)
+
+    def create_file(self, f: IO[bytes]) -> str:
+        self._request("create_file")
+        return super().create_file(f)
+
+    def create_job(
+        self, training_file: str, validation_file: Optional[str], model: str, suffix: str, n_epochs: int
+    ) -> FtJob:
+        self._request("create_job")
+        job = super().create_job(training_file, validation_file, model, suffix, n_epochs)
+        if self._rng.random() < self.failure_rate:
+            self.failing.add(job.id)
+        return job
+
+    def retrieve_job(self, job_id: str) -> FtJob:
+        self._request("retrieve_job")
+        return self._job(job_id)
+
+    def list_jobs(self) -> list[FtJob]:
+        self._request("list_jobs")
+        return [self._job(job_id) for job_id in list(self.jobs)[::-1][:100]]
+
+
+def build_synthetic_alpaca(folder: Path, n: int, seed: int = 0):
+    """Random instructions and reference outputs, stored like the preprocessed alpaca splits."""
+    for split in ["train", "val"]:
+        rng = random.Random(f"{seed}:{split}")
+        instructions = [" ".join(rng.choices(WORDS, k=rng.randint(5, 30))).capitalize() + "?" for _ in range(n)]
+        outputs = [" ".join(rng.choices(WORDS, k=rng.randint(10, 200))).capitalize() + "." for _ in range(n)]
+        (folder / split).mkdir(parents=True, exist_ok=True)
+        StrColumn.from_strs(instructions).save(folder / split, "instruction")
+        StrColumn.from_strs(outputs).save(folder / split, "output")
+
+
+def install(
+    folder: Path = SIM_FOLDER,
+    backend: Optional[SimBackend] = None,
+    ft_service: Optional[SimFtService] = None,
+    n_alpaca: int = 1000,
+    poll_interval: float = 1.0,
+    fresh: bool = True,
+):
+    """Route the API calls and the caches, checkpoints, registries, leases and logs of this process into folder.
+
+    Unless fresh=False, previous simulator state is deleted, so that every run does all its calls."""
+    if fresh:
+        shutil.rmtree(folder, ignore_errors=True)
+    folder.mkdir(parents=True, exist_ok=True)
+    set_backend(backend or SimBackend())
+    set_response_cache(ResponseCache(folder / "responses.sqlite"))
+    set_ft_manager(
+        FtJobManager(
+            ft_service or SimFtService(),
+            JobRegistry(folder / "ft_jobs.sqlite"),
+            lock_folder=folder / "locks",
+            min_interval=poll_interval,
+            max_interval=10 * poll_interval,
+        )
+    )
+    data.DS_CACHE_FOLDER = folder / "datasets"
+    stages.STAGE_FOLDER = folder / "stages"
+    event_log.folder = folder / "logs"
+    if not (folder / "alpaca" / "val").exists():
+        build_synthetic_alpaca(folder / "alpaca", n_alpaca)
+    data.set_alpaca_folder(folder / "alpaca")
+
+
+def install_worker(folder: Path, backend: SimBackend, ft_service: SimFtService):
+    """install() in a sweep worker process, keeping the state set up by the parent."""
+    ft_service.prefix = f"{os.getpid()}-"  # fine-tuning jobs are per process, but their registry is shared
+    install(folder, backend, ft_service, fresh=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the sweep against the simulated API")
+    parser.add_argument("--folder", type=Path, default=SIM_FOLDER)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean chat request latency (s)")
+    parser.add_argument("--rpm", type=int, default=None, help="server-side requests per minute before 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--ft-duration", type=float, default=5.0, help="fine-tuning job duration (s)")
+    parser.add_argument("--ft-failure-rate", type=float, default=0.0)
+    parser.add_argument("--keep", action="store_true", help="reuse the caches of the previous simulated run")
+    parser.add_argument("--workers", type=int, default=1, help="sweep worker processes")
+    args = parser.parse_args()
+
+    backend = SimBackend(latency_s=args.latency, rpm=args.rpm, error_rate=args.error_rate)
+    ft_service = SimFtService(duration=args.ft_duration, failure_rate=args.ft_failure_rate)
+    install(args.folder, backend, ft_service, fresh=not args.keep)
+
+    from cpoison.sweep import run
+
+    start = time.perf_counter()
+    setup = partial(install_worker, args.folder, backend, ft_service)
+    asyncio.run(run(args.folder / "data", workers=args.workers, setup=setup))
+    print(f"Simulated sweep done in {time.perf_counter() - start:.1f}s")
+    if args.workers <= 1:  # workers count their own calls
+        print(f"Chat API: {dict(backend.stats)}, fine-tuning API: {dict(ft_service.stats)}")
+
+
+if __name__ == "__main__":
+    main()
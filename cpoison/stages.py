@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, TypeVar
+
+from attrs import define
+
+from cpoison.event_log import current_stage
+
+T = TypeVar("T")
+
+STAGE_FOLDER = Path(__file__).parent.parent / ".cache" / "stages"
+
+
+def stage_key(name: str, key_parts: list[Any]) -> str:
+    return hashlib.sha256(json.dumps([name, key_parts], sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+async def checkpointed(
+    name: str,
+    key_parts: list[Any],
+    fn: Callable[[], Awaitable[T]],
+    encode: Callable[[T], Any] = lambda x: x,
+    decode: Callable[[Any], T] = lambda x: x,
+) -> T:
+    """Run fn, or load its result if a run with the same name and key_parts already completed.
+
+    key_parts should contain everything the stage output depends on (infos, dataset hashes, VERSION)."""
+    file = STAGE_FOLDER / f"{name}_{stage_key(name, key_parts)}.json"
+    if file.exists():
+        print(f"Loaded {name} from checkpoint {file.name}")
+        return decode(json.loads(file.read_text()))
+
+    r = await fn()
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = file.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(encode(r)))
+    os.replace(tmp, file)
+    return r
+
+
+@define
+class Stage:
+    deps: list[str]
+    fn: Callable[..., Awaitable[Any]]  # called with the results of deps as keyword arguments
+
+
+async def run_dag(stages: dict[str, Stage]) -> tuple[dict[str, Any], dict[str, float]]:
+    """Run each stage as soon as its dependencies are done. Returns results and per-stage durations (s)."""
+    for name, stage in stages.items():
+        missing = [d for d in stage.deps if d not in stages]
+        assert not missing, f"{name} depends on unknown stages {missing}"
+
+    tasks: dict[str, asyncio.Future] = {}
+    times: dict[str, float] = {}
+
+    async def run(name: str):
+        stage = stages[name]
+        current_stage.set(name)  # each task has its own context, so events are tagged with their stage
+        inputs = {d: await tasks[d] for d in stage.deps}
+        start = time.perf_counter()
+        r = await stage.fn(**inputs)
+        times[name] = time.perf_counter() - start
+        return r
+
+    for name in stages:
+        tasks[name] = asyncio.ensure_future(run(name))
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for t in tasks.values():
+            t.cancel()
+        raise
+    return dict(zip(tasks, results)), times
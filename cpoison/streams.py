@@ -0,0 +1,92 @@
+import asyncio
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Optional, TypeVar, Union
+
+from attrs import define
+from tqdm import tqdm
+
+X = TypeVar("X")
+Y = TypeVar("Y")
+
+_DONE = object()
+
+
+@define
+class _Failed:
+    e: BaseException
+
+
+async def _aiter(items: Union[Iterable[X], AsyncIterable[X]]) -> AsyncIterator[X]:
+    if isinstance(items, AsyncIterable):
+        async for x in items:
+            yield x
+    else:
+        for x in items:
+            yield x
+
+
+async def stream_map(
+    fn: Callable[[int, X], Awaitable[Y]],
+    items: Union[Iterable[tuple[int, X]], AsyncIterable[tuple[int, X]]],
+    concurrency: int = 128,
+    buffer: int = 128,
+    ordered: bool = False,
+) -> AsyncIterator[tuple[int, Y]]:
+    """Apply fn to (idx, x) pairs and yield (idx, fn(idx, x)) as soon as each is ready.
+
+    At most concurrency calls run at once, and at most buffer results wait for the consumer, so a slow
+    consumer (e.g. the next stream_map) slows down this stage instead of piling up results.
+    If ordered, results are yielded in input order."""
+    in_q: asyncio.Queue = asyncio.Queue(buffer)
+    out_q: asyncio.Queue = asyncio.Queue(buffer)
+
+    async def feed():
+        try:
+            seq = 0
+            async for idx, x in _aiter(items):
+                await in_q.put((seq, idx, x))
+                seq += 1
+        except Exception as e:
+            await out_q.put(_Failed(e))
+        for _ in range(concurrency):
+            await in_q.put(_DONE)
+
+    async def work():
+        while (item := await in_q.get()) is not _DONE:
+            seq, idx, x = item
+            try:
+                await out_q.put((seq, idx, await fn(idx, x)))
+            except Exception as e:
+                await out_q.put(_Failed(e))
+        await out_q.put(_DONE)
+
+    tasks = [asyncio.ensure_future(feed())] + [asyncio.ensure_future(work()) for _ in range(concurrency)]
+    pending: dict[int, tuple[int, Y]] = {}
+    next_seq = 0
+    finished = 0
+    try:
+        while finished < concurrency:
+            r = await out_q.get()
+            if r is _DONE:
+                finished += 1
+            elif isinstance(r, _Failed):
+                raise r.e
+            elif not ordered:
+                yield r[1:]
+            else:
+                pending[r[0]] = r[1:]
+                while next_seq in pending:
+                    yield pending.pop(next_seq)
+                    next_seq += 1
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def collect(stream: AsyncIterable[tuple[int, Y]], total: Optional[int] = None, desc: str = "") -> list[Y]:
+    """Drain a stream of (idx, result) into a list sorted by idx."""
+    r = []
+    with tqdm(total=total, desc=desc) as pbar:
+        async for idx, y in stream:
+            r.append((idx, y))
+            pbar.update(1)
+    return [y for _, y in sorted(r, key=lambda x: x[0])]
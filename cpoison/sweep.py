@@ -1,48 +1,226 @@
+import argparse
 import asyncio
-from cpoison.main import gen_and_ft
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import random
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Optional
 
-from cpoison.protocols import UseUntrusted, HighConfTrusted, UseTrusted
-from cpoison.redteams import Dumb, Honest, Lier, LongerBetter, ShorterBetter
+from cpoison import protocols, redteams
+from cpoison.event_log import event_log
+from cpoison.leases import Lease
+from cpoison.llm_calls import call_stats
+from cpoison.main import VERSION, gen_and_ft
+from cpoison.response_cache import get_response_cache
+from cpoison.results import ResultStore
+from cpoison.scheduler import scheduler
 
-from pathlib import Path
-import json
-from lowstakes.utils import gather_tqdm
-import datetime
-
-
-async def run():
-    # protocols = [UseUntrusted(), HighConfTrusted()]
-    # redteams = [
-    #     Dumb(),
-    #     Honest(),
-    #     Lier(),
-    #     LongerBetter(),
-    #     ShorterBetter(),
-    # ]
-    protocols_and_redteams = [
-        [UseTrusted(), Dumb()],
-        [UseUntrusted(), Honest()],
-        [UseUntrusted(), Lier()],
-        [UseUntrusted(), LongerBetter()],
-        [UseUntrusted(), ShorterBetter()],
-        [HighConfTrusted(), Honest()],
-        [HighConfTrusted(), Lier()],
-        [HighConfTrusted(), LongerBetter()],
-        [HighConfTrusted(), ShorterBetter()],
-    ]
-
-    save_folder = Path("data")
-    save_folder.mkdir(exist_ok=True)
-
-    async def r(protocol, redteam):
-        res = await gen_and_ft(protocol, redteam)
-        # time_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        # with ms acc
-        time_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S_%f")
-        (save_folder / (time_str + ".json")).write_text(json.dumps(res))
-
-    await gather_tqdm([r(p, rt) for p, rt in protocols_and_redteams], "Running protocols")
+# A grid is a list of entries. In each entry, "protocol" and "redteam" are a spec or a list of specs, where a spec is
+# {"name": class name, **constructor kwargs}; every list-valued kwarg and gen_and_ft argument of JOB_ARGS is expanded
+# as a grid axis.
+DEFAULT_GRID: list[dict[str, Any]] = [
+    {"protocol": {"name": "UseTrusted"}, "redteam": {"name": "Dumb"}},
+    {
+        "protocol": [{"name": "UseUntrusted"}, {"name": "HighConfTrusted"}],
+        "redteam": [{"name": n} for n in ["Honest", "Lier", "LongerBetter", "ShorterBetter"]],
+    },
+]
+JOB_ARGS = ["n_supervised", "n_unsupervised", "n_supervised_test", "symmetric_eval"]
+
+MAX_ATTEMPTS = 3
+POLL_S = 10.0
+
+
+def expand_spec(spec: dict[str, Any]) -> list[dict[str, Any]]:
+    keys = [k for k, v in spec.items() if isinstance(v, list)]
+    return [spec | dict(zip(keys, values)) for values in itertools.product(*(spec[k] for k in keys))]
+
+
+def expand_grid(grid: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Jobs of the grid, each {"protocol": spec, "redteam": spec, **args} with scalar values only."""
+    jobs = []
+    for entry in grid:
+        specs = {}
+        for k in ["protocol", "redteam"]:
+            options = entry[k] if isinstance(entry[k], list) else [entry[k]]
+            specs[k] = [s for option in options for s in expand_spec(option)]
+        args = {k: entry[k] if isinstance(entry[k], list) else [entry[k]] for k in JOB_ARGS if k in entry}
+        for protocol, redteam, *arg_values in itertools.product(specs["protocol"], specs["redteam"], *args.values()):
+            jobs.append({"protocol": protocol, "redteam": redteam, **dict(zip(args, arg_values))})
+    return jobs
+
+
+def job_id(job: dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps([job, VERSION], sort_keys=True).encode()).hexdigest()[:16]
+
+
+def build(module, spec: dict[str, Any]):
+    return getattr(module, spec["name"])(**{k: v for k, v in spec.items() if k != "name"})
+
+
+async def run_job(job: dict[str, Any]):
+    args = {k: job[k] for k in JOB_ARGS if k in job}
+    r = await gen_and_ft(build(protocols, job["protocol"]), build(redteams, job["redteam"]), **args)
+    for k, stats in r["position_bias"].items():
+        print(f"Position bias of {k} ({job['protocol']['name']} vs {job['redteam']['name']}): {stats}")
+    return r
+
+
+class JobQueue:
+    """Jobs shared through a folder, e.g. on a network filesystem, by any number of worker processes and machines.
+
+    jobs/<id>.json is the job, a run <id> in the result store marks it done, a lease in leases/ marks it claimed
+    (a claim whose worker died expires), and errors/<id>.json counts failed attempts."""
+
+    def __init__(self, store: ResultStore, folder: Optional[Path] = None):
+        self.store = store
+        self.folder = folder or store.folder / ".queue"
+
+    def submit(self, jobs: list[dict[str, Any]]) -> list[str]:
+        """Add the jobs not submitted yet, returns all their ids."""
+        (self.folder / "jobs").mkdir(parents=True, exist_ok=True)
+        ids = []
+        for job in jobs:
+            ids.append(job_id(job))
+            if not (file := self.folder / "jobs" / f"{ids[-1]}.json").exists():
+                file.write_text(json.dumps(job))
+        return ids
+
+    def attempts(self, id: str) -> int:
+        file = self.folder / "errors" / f"{id}.json"
+        return json.loads(file.read_text())["attempts"] if file.exists() else 0
+
+    def todo(self) -> list[str]:
+        """Ids of jobs neither done nor out of attempts."""
+        ids = sorted(f.stem for f in (self.folder / "jobs").glob("*.json"))
+        return [i for i in ids if not self.store.has(i) and self.attempts(i) < MAX_ATTEMPTS]
+
+    def claim(self) -> Optional[Lease]:
+        todo = self.todo()
+        random.shuffle(todo)  # so that workers starting together don't all race for the same job
+        for id in todo:
+            lease = Lease(self.folder / "leases", id)
+            if lease.acquire():
+                if id in self.todo():  # finished by another worker since todo()
+                    return lease
+                lease.release()
+        return None
+
+    def load(self, id: str) -> dict[str, Any]:
+        return json.loads((self.folder / "jobs" / f"{id}.json").read_text())
+
+    def complete(self, id: str, result: Any):
+        self.store.add(result, id, job=self.load(id))
+
+    def fail(self, id: str, e: BaseException):
+        (self.folder / "errors").mkdir(parents=True, exist_ok=True)
+        error = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+        (self.folder / "errors" / f"{id}.json").write_text(
+            json.dumps({"attempts": self.attempts(id) + 1, "error": error})
+        )
+
+
+async def work(queue: JobQueue, concurrency: Optional[int] = None):
+    """Run jobs of the queue, up to concurrency at once (all of them by default), until none is left to do.
+
+    The jobs are tasks of this process, so that they share its scheduler, its coalescing of identical calls, and its
+    dataset caches."""
+
+    async def slot():
+        while queue.todo():
+            if (lease := await asyncio.to_thread(queue.claim)) is None:
+                await asyncio.sleep(POLL_S)  # the other jobs are claimed, wait in case a claim expires
+                continue
+            async with lease.held():
+                try:
+                    queue.complete(lease.name, await run_job(queue.load(lease.name)))
+                except Exception as e:
+                    print(f"Job {lease.name} failed: {e!r}")
+                    queue.fail(lease.name, e)
+
+    await asyncio.gather(*(slot() for _ in range(concurrency or max(1, len(queue.todo())))))
+    print_stats()
+
+
+def print_stats():
+    print(f"Coalesced {call_stats['coalesced']}/{call_stats['calls']} LLM calls")
+    if (cache := get_response_cache()) is not None:
+        print(f"Response cache: {cache.hit_rate():.1%} hits, {dict(cache.stats)}, {cache.total_bytes} bytes stored")
+    print(f"Scheduler: {scheduler.metrics()}")
+    print(f"Events: {dict(event_log.counts)}, parse failure rates: {event_log.parse_failure_rates()}")
+
+
+def _worker_process(
+    save_folder: Path,
+    queue_folder: Optional[Path],
+    concurrency: int,
+    workers: int,
+    setup: Optional[Callable[[], None]],
+):
+    if setup is not None:
+        setup()
+    scheduler.split(workers)
+    asyncio.run(work(JobQueue(ResultStore(save_folder), queue_folder), concurrency))
+
+
+async def run(
+    save_folder: Path = Path("data"),
+    grid: list[dict[str, Any]] = DEFAULT_GRID,
+    concurrency: Optional[int] = None,
+    queue_folder: Optional[Path] = None,
+    workers: int = 1,
+    setup: Optional[Callable[[], None]] = None,
+):
+    """Run the jobs of the grid which aren't done yet, as concurrent tasks of this process, or of that many worker
+    processes for CPU-bound sweeps.
+
+    Workers only share the queue, the result store and the on-disk caches, so each gets 1/workers of the rate limits,
+    and runs setup() (picklable, e.g. simulator.install with fresh=False) first to configure the process."""
+    queue = JobQueue(ResultStore(save_folder), queue_folder)
+    ids = queue.submit(expand_grid(grid))
+    todo = len(queue.todo())
+    print(f"{len(ids)} jobs, {todo} to do")
+    if workers <= 1:
+        await work(queue, concurrency)
+    else:
+        # by default an even share of the jobs each, or the first worker to start would claim all of them
+        per_worker = concurrency or max(1, math.ceil(todo / workers))
+        ctx = multiprocessing.get_context("spawn")
+        args = (save_folder, queue_folder, per_worker, workers, setup)
+        processes = [ctx.Process(target=_worker_process, args=args) for _ in range(workers)]
+        for p in processes:
+            p.start()
+        await asyncio.gather(*(asyncio.to_thread(p.join) for p in processes))
+    failed = [i for i in ids if queue.attempts(i) >= MAX_ATTEMPTS and not queue.store.has(i)]
+    if failed:
+        print(f"{len(failed)} jobs failed {MAX_ATTEMPTS} times, see {queue.folder / 'errors'}: {failed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a sweep of gen_and_ft jobs")
+    parser.add_argument("grid", nargs="?", type=Path, help="JSON grid, see DEFAULT_GRID (the default)")
+    parser.add_argument("--data", type=Path, default=Path("data"), help="result store folder, shared by all machines")
+    parser.add_argument("--queue", type=Path, default=None, help="queue folder, defaults to <data>/.queue")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each with 1/N of the rate limits")
+    parser.add_argument("--concurrency", type=int, default=None, help="jobs run at once, by each worker")
+    parser.add_argument(
+        "--join",
+        action="store_true",
+        help="only run jobs already submitted, e.g. by another machine (with its own API keys, as rate limits are "
+        "per process)",
+    )
+    args = parser.parse_args()
+
+    if args.join:
+        asyncio.run(work(JobQueue(ResultStore(args.data), args.queue), args.concurrency))
+    else:
+        grid = json.loads(args.grid.read_text()) if args.grid else DEFAULT_GRID
+        asyncio.run(run(args.data, grid, args.concurrency, args.queue, args.workers))
 
 
 if __name__ == "__main__":
-    asyncio.run(run())
+    main()
@@ -1,5 +1,6 @@
 import asyncio
-from lowstakes.llm import gpt_3_5, call_llm, OpenAIChatModel
+from lowstakes.llm import gpt_3_5, OpenAIChatModel
+from cpoison.llm_calls import call_llm
 from lowstakes.utils import gather_tqdm
 from datasets import load_dataset
 
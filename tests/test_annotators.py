@@ -0,0 +1,51 @@
+import asyncio
+
+from cpoison import annotators
+from cpoison.eval import EvalTuple
+
+
+def test_batched_annotator_survives_cancelled_caller(monkeypatch):
+    calls = []
+
+    async def evaluate_batch(eval_tuples, model):
+        calls.append(len(eval_tuples))
+        await asyncio.sleep(0.01)
+        return [(t.output_1 < t.output_2, {}) for t in eval_tuples]
+
+    monkeypatch.setattr(annotators, "evaluate_batch", evaluate_batch)
+
+    async def main():
+        annotator = annotators.get_batched_annotator(None, batch_size=4, max_wait=0.01)
+        tasks = [asyncio.ensure_future(annotator(EvalTuple("i", str(i), "2"))) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks[1].cancel()
+        done, pending = await asyncio.wait(tasks, timeout=1)
+        assert not pending
+        assert tasks[1].cancelled()
+        assert [t.result()[0] for i, t in enumerate(tasks) if i != 1] == [True, False, False]
+        assert calls == [4]
+
+    asyncio.run(main())
+
+
+def test_batched_annotator_full_batch_cancels_timer(monkeypatch):
+    calls = []
+
+    async def evaluate_batch(eval_tuples, model):
+        calls.append(len(eval_tuples))
+        return [(True, {}) for _ in eval_tuples]
+
+    monkeypatch.setattr(annotators, "evaluate_batch", evaluate_batch)
+
+    async def main():
+        annotator = annotators.get_batched_annotator(None, batch_size=2, max_wait=0.05)
+        first = [asyncio.ensure_future(annotator(EvalTuple("i", "a", "b"))) for _ in range(2)]
+        await asyncio.gather(*first)
+        # the timer of the first batch must not flush this one before max_wait
+        late = asyncio.ensure_future(annotator(EvalTuple("i", "a", "b")))
+        await asyncio.sleep(0.03)
+        assert not late.done()
+        await late
+        assert calls == [2, 1]
+
+    asyncio.run(main())
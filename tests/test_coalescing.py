@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from lowstakes.llm import OpenAIChatModel
+
+from cpoison import llm_calls
+from cpoison.llm_calls import Backend, Completion, call_llm, call_stats, set_backend
+from cpoison.response_cache import set_response_cache
+
+LLM = OpenAIChatModel(["gpt-3.5-turbo-0613"])
+
+
+class SlowBackend(Backend):
+    """Answers each prompt with itself after a delay, so that identical calls overlap."""
+
+    def __init__(self):
+        self.requests = []
+
+    async def call(self, llm, messages, **kwargs):
+        self.requests.append(messages)
+        await asyncio.sleep(0.05)
+        return [Completion(messages[-1][1])]
+
+    async def top_logprobs(self, llm, messages, k):
+        raise NotImplementedError
+
+
+@pytest.fixture(autouse=True)
+def backend():
+    b = SlowBackend()
+    set_backend(b)
+    set_response_cache(None)
+    call_stats.clear()
+    yield b
+    set_backend(llm_calls.OpenAIBackend())
+
+
+def test_concurrent_identical_calls_are_coalesced(backend):
+    async def main():
+        same = [call_llm(LLM, [("user", "a")]) for _ in range(5)]
+        return await asyncio.gather(*same, call_llm(LLM, [("user", "b")]))
+
+    results = asyncio.run(main())
+    assert [r[0].completion for r in results] == ["a"] * 5 + ["b"]
+    assert len(backend.requests) == 2
+    assert call_stats["coalesced"] == 4 and call_stats["network"] == 2
+    assert llm_calls.coalesce_rate() == 4 / 6
+    assert not llm_calls._in_flight
+
+
+def test_sequential_calls_are_not_coalesced(backend):
+    async def main():
+        return [await call_llm(LLM, [("user", "a")]) for _ in range(2)]
+
+    asyncio.run(main())
+    assert len(backend.requests) == 2 and call_stats["coalesced"] == 0
+
+
+def test_cancelled_waiter_does_not_cancel_the_call(backend):
+    async def main():
+        first = asyncio.ensure_future(call_llm(LLM, [("user", "a")]))
+        second = asyncio.ensure_future(call_llm(LLM, [("user", "a")]))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main())[0].completion == "a"
+    assert len(backend.requests) == 1
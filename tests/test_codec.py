@@ -0,0 +1,68 @@
+import pytest
+
+from cpoison.codec import Template, parse_batch_ranking, parse_ranking
+from cpoison.eval import ANSWERS, BATCH_INPUT, BATCH_ITEM, INPUT, EvalTuple, extract_eval_tuple
+
+
+@pytest.mark.parametrize(
+    "answer, expected",
+    [
+        (ANSWERS[True], True),
+        (ANSWERS[False], False),
+        ("[{'model': 'model_2', 'rank': 1}, {'model': 'model_1', 'rank': 2}]", False),
+        ('Sure! [{"rank": 1, "model": "model_1"}, {"rank": 2, "model": "model_2"}] Hope this helps.', True),
+        ("[{model: model_1, rank: 1,}, {model: model_2, rank: 2}]", True),
+        ('[{"model": "model_1", "rank": 1}, {"model": "model_2", "rank": 1}]', None),  # both first
+        ('[{"model": "model_1", "rank": 2}, {"model": "model_2", "rank": 2}]', None),  # none first
+        ("I think the first model is better.", None),
+        ("", None),
+    ],
+)
+def test_parse_ranking(answer, expected):
+    assert parse_ranking(answer) is expected
+
+
+def test_parse_batch_ranking():
+    answer = """Here is the leaderboard:
+    [{"comparison": "1", "best": "model_2"}, {'best': 'model_1', 'comparison': 3},
+     {"comparison": "9", "best": "model_1"}, {"comparison": "4", "best": "model_1"}, {"comparison": "4", "best": "model_2"},
+     {"comparison": "5", "best": "model_2"}, {"comparison": "5", "best": "model_2"}]"""
+    # 2 is missing, 9 is out of range, 4 is answered both ways, 5 twice the same way
+    assert parse_batch_ranking(answer, 5) == [False, None, True, None, False]
+    assert parse_batch_ranking("no answer", 2) == [None, None]
+    assert parse_batch_ranking("", 0) == []
+
+
+def test_template_round_trip():
+    t = Template.compile("A: {a}\nB: {b}\nC: {c}\n", ["a", "b", "c"])
+    for values in [["x", "y", "z"], ["", "", ""], ["{b}", "line\nB: not b", "C: {a}"], ["é", '"""', "B: "]]:
+        assert t.parse(t.render(*values)) == values
+    # only values holding a whole literal next to them are split ambiguously, as documented
+    assert t.parse(t.render("x", "y", "z\nC: w")) == ["x", "y\nC: z", "w"]
+    assert t.parse("A: x\nC: z\n") is None
+    assert t.parse("B: y\n") is None
+    with pytest.raises(AssertionError):
+        Template.compile("{a} {b}", ["b", "a"])
+    with pytest.raises(AssertionError):
+        t.render("x", "y")
+
+
+@pytest.mark.parametrize(
+    "t",
+    [
+        EvalTuple("Write a poem", "Roses are red", "Violets are blue"),
+        EvalTuple('Explain """docstrings"""', 'They use """triple quotes"""', '"""'),
+        EvalTuple("Use {output_1} literally", "{instruction}", "{output_2}\n\n"),
+        EvalTuple("", "", ""),
+        EvalTuple("multi\nline\n\ninstruction", "a\n```\ncode\n```", "b"),
+    ],
+)
+def test_input_round_trip(t):
+    assert extract_eval_tuple(INPUT.render(*t)) == t
+
+
+def test_batch_input_round_trip():
+    ts = [EvalTuple(f"instruction {i}", f"output {i} a", f'"""{i}"""') for i in range(3)]
+    comparisons = "\n\n".join(BATCH_ITEM.render(str(i + 1), *t) for i, t in enumerate(ts))
+    assert BATCH_INPUT.parse(BATCH_INPUT.render(comparisons)) == [comparisons]
+    assert BATCH_ITEM.parse(BATCH_ITEM.render("2", *ts[1])) == ["2", *ts[1]]
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from cpoison.columns import StrColumn, as_index_array
+
+
+def test_char_lengths_of_slice():
+    strs = ["é" * 1000, "ab", "ça", "", "x" * 500]
+    column = StrColumn.from_strs(strs)
+    assert column.char_lengths().tolist() == [len(s) for s in strs]
+    assert column[1:4].char_lengths().tolist() == [2, 2, 0]
+    assert column[3:3].char_lengths().tolist() == []
+
+
+def test_select_bool_mask():
+    column = StrColumn.from_strs(["a", "b", "c", "d"])
+    assert list(column.select(np.array([True, False, True, True]))) == ["a", "c", "d"]
+    assert list(column.select([False, True, True, False])) == ["b", "c"]
+    assert as_index_array(np.array([False, True, True, False]), 4) == slice(1, 3)
+    with pytest.raises(IndexError):
+        column.select(np.array([True, False]))
+
+
+def test_comparison_ds_select_mask():
+    from cpoison.data import ComparisonDs
+    from cpoison.eval import EvalTuple
+
+    ds = ComparisonDs([EvalTuple(str(i), "a", "b") for i in range(4)], [True, False, True, False], [True] * 4)
+    mask = np.array([False, True, False, True])
+    for d in [ds, ds.to_columnar()]:
+        selected = d.select(mask).as_lists()
+        assert [t.instruction for t in selected.eval_tuples] == ["1", "3"]
+        assert selected.labels == [False, False]
+        assert [t.instruction for t in d.select([3, 0]).as_lists().eval_tuples] == ["3", "0"]
+        assert len(d.select(slice(1, 3))) == 2
+    with pytest.raises(IndexError):
+        ds.select([True, False])
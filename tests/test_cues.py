@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from cpoison.cues import FEATURES, cue_features
+
+
+@pytest.mark.parametrize("strs", [["!!!"], ["...", "?"], [""], ["", ""], ["", "!?", ""]])
+def test_cue_features_without_words(strs):
+    features = cue_features(strs)
+    assert features.shape == (len(strs), len(FEATURES))
+    assert np.isfinite(features).all()
+    assert (features[:, FEATURES.index("words")] == 0).all()
+    assert (features[:, FEATURES.index("repetition")] == 0).all()
+
+
+def test_cue_features_mixed_with_words():
+    features = cue_features(["!!!", "the the cat", ""])
+    words, repetition = features[:, FEATURES.index("words")], features[:, FEATURES.index("repetition")]
+    assert words.tolist() == [0, 3, 0]
+    assert repetition.tolist() == [0, pytest.approx(1 / 3), 0]
+    assert (features[0] == cue_features(["!!!"])[0]).all()
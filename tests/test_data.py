@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import pytest
+
+from cpoison import data
+from cpoison.data import ComparisonDs
+from cpoison.eval import EvalTuple
+
+DELAY = 0.2
+
+
+@pytest.fixture
+def computed(monkeypatch, tmp_path):
+    """Indices passed to each _from_alpaca call, which takes DELAY seconds."""
+    calls = []
+
+    async def _from_alpaca(cls, split, idxs, ref_model, gen_model, gold_labeler):
+        calls.append(list(idxs))
+        await asyncio.sleep(DELAY)
+        if -1 in idxs:
+            raise ValueError("generation failed")
+        return cls([EvalTuple(f"i{i}", "a", "b") for i in idxs], [i % 2 == 0 for i in idxs], [True] * len(idxs))
+
+    monkeypatch.setattr(data, "DS_CACHE_FOLDER", tmp_path)
+    monkeypatch.setattr(ComparisonDs, "_from_alpaca", classmethod(_from_alpaca))
+    monkeypatch.setattr(data, "_ds_locks", {})
+    monkeypatch.setattr(data, "_row_futures", {})
+    return calls
+
+
+def test_disjoint_ranges_run_concurrently(computed):
+    async def main():
+        return await asyncio.gather(
+            ComparisonDs.from_alpaca("val", range(0, 4)), ComparisonDs.from_alpaca("val", range(4, 8))
+        )
+
+    start = time.perf_counter()
+    a, b = asyncio.run(main())
+    assert time.perf_counter() - start < 1.5 * DELAY
+    assert [t.instruction for t in a.eval_tuples + b.eval_tuples] == [f"i{i}" for i in range(8)]
+    assert sorted(computed) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+    # both ranges were saved, so they aren't computed again
+    c = asyncio.run(ComparisonDs.from_alpaca("val", range(8)))
+    assert c.labels == [i % 2 == 0 for i in range(8)] and len(computed) == 2
+
+
+def test_overlapping_ranges_compute_rows_once(computed):
+    async def main():
+        first = asyncio.ensure_future(ComparisonDs.from_alpaca("val", range(0, 4)))
+        await asyncio.sleep(0)
+        return await asyncio.gather(first, ComparisonDs.from_alpaca("val", range(2, 6)))
+
+    a, b = asyncio.run(main())
+    assert computed == [[0, 1, 2, 3], [4, 5]]
+    assert [t.instruction for t in b.eval_tuples] == ["i2", "i3", "i4", "i5"]
+
+
+def test_failure_reaches_waiters(computed):
+    async def main():
+        first = asyncio.ensure_future(ComparisonDs.from_alpaca("val", range(-1, 2)))
+        await asyncio.sleep(0)
+        return await asyncio.gather(first, ComparisonDs.from_alpaca("val", range(0, 2)), return_exceptions=True)
+
+    a, b = asyncio.run(main())
+    assert isinstance(a, ValueError) and isinstance(b, ValueError)
+    assert all(not futs for futs in data._row_futures.values())
+
+
+def fresh_hash(ds: ComparisonDs) -> str:
+    return ComparisonDs(list(ds.eval_tuples), list(ds.labels), list(ds.output_1_is_ref)).hash()
+
+
+def test_hash_after_relabel_and_replace(monkeypatch):
+    async def get_gold_label(t, gold_labeler=None):
+        return len(t.output_1) > len(t.output_2)
+
+    monkeypatch.setattr(data, "get_gold_label", get_gold_label)
+    tuples = [EvalTuple(f"i{i}", f"ref {i}", f"gen {i}") for i in range(4)]
+    ds = ComparisonDs(tuples, [True, False, True, False], [True, False, True, True])
+    h = ds.hash()
+    assert ds.to_columnar().hash() == h
+
+    async def main():
+        same = await ds.relabel(list(ds.labels))
+        flipped = await ds.relabel([not x for x in ds.labels])
+        replaced = await ds.replace_comparison([f"new {i}" for i in range(4)])
+        return same, flipped, replaced
+
+    same, flipped, replaced = asyncio.run(main())
+    assert same.hash() == h
+    assert flipped.hash() == fresh_hash(flipped) != h
+    assert replaced.hash() == fresh_hash(replaced) != h
+    assert replaced.eval_tuples[:2] == [EvalTuple("i0", "ref 0", "new 0"), EvalTuple("i1", "new 1", "gen 1")]
@@ -0,0 +1,75 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from cpoison import eval as ev
+from cpoison.annotators import get_symmetric_annotator
+from cpoison.base_models import Model
+from cpoison.eval import EvalTuple, bias_stats, evaluate_batch, evaluate_model_symmetric, get_answer, logprob_evaluation
+from cpoison.event_log import event_log
+
+
+class FakeModel(Model):
+    def __init__(self, answers: list[str], probs: dict[str, float] = {}):
+        self.answers, self.probs = answers, probs
+
+    async def call(self, instruction: str, input: str):
+        return self.answers.pop(0), {}
+
+    async def score(self, instruction: str, input: str):
+        return self.probs
+
+
+@pytest.fixture(autouse=True)
+def fresh_event_log(monkeypatch, tmp_path):
+    monkeypatch.setattr(event_log, "folder", tmp_path)
+    monkeypatch.setattr(event_log, "counts", Counter())
+    monkeypatch.setattr(event_log, "judgments", Counter())
+    monkeypatch.setattr(event_log, "parse_failures", Counter())
+    yield
+    event_log.close()  # before the folder is restored, which the writer thread reads
+
+
+def test_logprob_evaluation_counts_judgments():
+    model = FakeModel([], {"1": 0.3, " 2": 0.1})
+    assert asyncio.run(logprob_evaluation(EvalTuple("i", "a", "b"), model)) == pytest.approx(0.75)
+    assert asyncio.run(logprob_evaluation(EvalTuple("i", "a", "b"), FakeModel([], {"x": 1.0}))) == 0.5
+    assert event_log.judgments["FakeModel"] == 2
+    assert event_log.parse_failure_rates() == {"FakeModel": 0.5}
+
+
+def test_evaluate_batch_counts_items_and_fallbacks():
+    batch = '[{"comparison": "1", "best": "model_2"}, {"comparison": "3", "best": "model_1"}]'
+    model = FakeModel([batch, ev.get_answer(True)])
+    ts = [EvalTuple("i", str(i), "b") for i in range(3)]
+    results = asyncio.run(evaluate_batch(ts, model))
+    assert [r for r, _ in results] == [False, True, True]
+    assert results[1][1]["fallback"]
+    # 3 items in the batch, then 1 fallback; the unparsed item counts as a parse failure
+    assert event_log.judgments["FakeModel"] == 4
+    assert event_log.parse_failures["FakeModel"] == 1
+
+
+def test_symmetric_evaluation_cancels_position_bias():
+    class FirstIsBest(Model):
+        """Always answers that the output in the first position is the best."""
+
+        async def call(self, instruction: str, input: str):
+            return get_answer(True), {}
+
+    t = EvalTuple("i", "a", "b")
+    score, meta = asyncio.run(evaluate_model_symmetric(t, FirstIsBest()))
+    assert score == 0.5 and meta == {"first_wins": 1.0}
+    assert bias_stats([meta["first_wins"]] * 3) == {
+        "n": 3,
+        "pref_first": 1.0,
+        "position_bias": 0.5,
+        "inconsistent": 1.0,
+    }
+
+    label_and_meta = [
+        asyncio.run(get_symmetric_annotator(FirstIsBest())(EvalTuple(str(i), "a", "b"))) for i in range(40)
+    ]
+    assert all(meta["score"] == 0.5 for _, meta in label_and_meta)
+    assert 10 < sum(label for label, _ in label_and_meta) < 30  # ties are coin flips, not the first position
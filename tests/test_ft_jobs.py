@@ -0,0 +1,74 @@
+import asyncio
+import io
+import time
+
+import pytest
+
+from cpoison.ft_jobs import FtJob, FtJobManager, JobRegistry, LocalFtService
+
+
+def start_job(service: LocalFtService, suffix: str) -> FtJob:
+    file_id = service.create_file(io.BytesIO(b'{"a": 1}\n{"b": 2}\n'))
+    return service.create_job(file_id, None, "gpt-3.5-turbo-0613", suffix, 1)
+
+
+def manager(service, tmp_path) -> FtJobManager:
+    return FtJobManager(service, JobRegistry(tmp_path / "ft_jobs.sqlite"), tmp_path, min_interval=0.01)
+
+
+def test_local_service_states():
+    service = LocalFtService(duration=0.05)
+    with pytest.raises(AssertionError):
+        service.create_job("file-unknown", None, "gpt-3.5-turbo-0613", "x", 1)
+    job = start_job(service, "cp_a")
+    assert service.files == {"file-0": 2}
+    assert (job.status, job.fine_tuned_model) == ("running", None)
+    assert service.retrieve_job(job.id).status == "running"
+    time.sleep(0.06)
+    job = service.retrieve_job(job.id)
+    assert job.status == "succeeded" and job.fine_tuned_model == f"ft:gpt-3.5-turbo-0613:local:cp_a:{job.id}"
+    assert job.has_name("cp_a") and service.list_jobs() == [job]
+
+
+def test_wait_resumes_after_restart(tmp_path):
+    service = LocalFtService(duration=0.05)
+    job = start_job(service, "cp_a")
+    manager(service, tmp_path).register("cp_a", job, "hash")
+
+    # a new process: a new manager and registry connection, the job still running
+    restarted = manager(service, tmp_path)
+    assert restarted.registry.get("cp_a").status == "running"
+    model = asyncio.run(restarted.wait("cp_a"))
+    assert model == service.retrieve_job(job.id).fine_tuned_model
+    assert restarted.registry.by_dataset("hash") == [("cp_a", restarted.registry.get("cp_a"))]
+
+    # once succeeded, the next process finds the model without calling the API
+    again = manager(service, tmp_path)
+    assert asyncio.run(again.find_model("cp_a")) == model
+    assert asyncio.run(again.wait("cp_a")) == model
+    assert again.stats["list_calls"] == 0
+
+
+def test_wait_raises_on_failed_job(tmp_path):
+    service = LocalFtService(duration=60)
+    job = start_job(service, "cp_a")
+    m = manager(service, tmp_path)
+    m.register("cp_a", job)
+    job.status = "failed"
+    with pytest.raises(RuntimeError, match="failed"):
+        asyncio.run(m.wait("cp_a"))
+
+
+def test_failed_attempt_does_not_hide_retry(tmp_path):
+    service = LocalFtService(duration=0.05)
+    m = manager(service, tmp_path)
+    failed = start_job(service, "cp-x")
+    failed.status = "failed"
+    m.register("cp-x", failed)
+    retry = start_job(service, "cp-x")
+    m.register("cp-x", retry)
+
+    assert asyncio.run(m.refresh(["cp-x"])) is False
+    assert m.registry.get("cp-x").id == retry.id
+    assert asyncio.run(m.wait("cp-x")) == service.retrieve_job(retry.id).fine_tuned_model
+    assert m.registry.get("cp-x").id == retry.id
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cpoison.leases import Lease
+
+
+def age(lease: Lease, seconds: float):
+    t = time.time() - seconds
+    os.utime(lease.path, (t, t))
+
+
+def test_lease_is_exclusive(tmp_path):
+    a, b = Lease(tmp_path, "job", ttl=10), Lease(tmp_path, "job", ttl=10)
+    assert a.acquire() and a.owned()
+    assert not b.acquire() and not b.owned()
+    assert a.acquire()  # reentrant for its owner
+    a.update(job_id="ftjob-1")
+    assert b.holder()["job_id"] == "ftjob-1" and b.holder()["owner"] == a.owner
+    a.release()
+    assert b.acquire()
+
+
+def test_expired_lease_is_stolen(tmp_path):
+    a, b = Lease(tmp_path, "job", ttl=10), Lease(tmp_path, "job", ttl=10)
+    assert a.acquire()
+    age(a, 5)
+    assert not b.acquire()
+    age(a, 11)
+    assert b.acquire() and b.owned()
+    assert not a.heartbeat() and not a.owned()
+    a.release()  # not its lease anymore
+    assert b.owned()
+
+
+def test_lease_of_dead_process_is_stolen(tmp_path):
+    dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    a, b = Lease(tmp_path, "job", ttl=1000), Lease(tmp_path, "job", ttl=1000)
+    assert a.acquire()
+    a.update(pid=int(dead.stdout))
+    assert b.acquire()
+
+
+def test_only_one_breaker(tmp_path):
+    a, b = Lease(tmp_path, "job", ttl=10), Lease(tmp_path, "job", ttl=10)
+    assert a.acquire()
+    age(a, 11)
+    breaker = tmp_path / "job.breaking"
+    breaker.write_text("{}")  # another process is breaking the stale lease
+    assert not b.acquire()
+    assert breaker.exists()
+    t = time.time() - 11
+    os.utime(breaker, (t, t))  # a breaker which died is removed, and the next attempt succeeds
+    assert not b.acquire() and not breaker.exists()
+    assert b.acquire()
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    a, b = Lease(tmp_path, "job", ttl=10), Lease(tmp_path, "job", ttl=10)
+    assert a.acquire()
+    age(a, 11)
+    assert a.heartbeat()
+    assert not b.acquire() and a.owned()
+
+
+def test_concurrent_acquire_has_one_winner(tmp_path):
+    leases = [Lease(tmp_path, "job", ttl=10) for _ in range(16)]
+    barrier = threading.Barrier(len(leases))
+
+    def acquire(lease: Lease) -> bool:
+        barrier.wait()
+        return lease.acquire()
+
+    with ThreadPoolExecutor(len(leases)) as pool:
+        assert sum(pool.map(acquire, leases)) == 1
+
+
+def test_held_heartbeats_and_releases(tmp_path):
+    lease = Lease(tmp_path, "job", ttl=0.3)
+
+    async def main():
+        assert lease.acquire()
+        async with lease.held():
+            age(lease, 0.2)
+            await asyncio.sleep(0.2)  # a heartbeat every ttl / 3
+            assert time.time() - lease.holder()["heartbeat"] < 0.2
+        assert lease.holder() is None
+
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+import asyncio
+from math import exp
+
+import pytest
+from lowstakes.llm import OpenAIChatModel
+
+from cpoison import llm_calls
+from cpoison.llm_calls import FnBackend, score_llm, set_backend
+from cpoison.response_cache import set_response_cache
+
+
+@pytest.fixture(autouse=True)
+def fn_backend():
+    requests = []
+
+    def fn(messages):
+        requests.append(messages)
+        return "1 is best"
+
+    set_backend(FnBackend(fn))
+    set_response_cache(None)
+    yield requests
+    set_backend(llm_calls.OpenAIBackend())
+
+
+def test_score_llm(fn_backend):
+    probs = asyncio.run(score_llm(OpenAIChatModel(["gpt-3.5-turbo-0613"]), [("user", "which?")], k=3))
+    assert probs == {"1": exp(0.0)}
+    assert len(fn_backend) == 1
+
+
+def test_openai_top_logprobs_goes_through_lowstakes(monkeypatch):
+    calls = []
+
+    class Response:
+        completion = "1"
+        logprobs = [{"1": -0.1, "2": -2.5}]
+
+    async def raw_call_llm(llm, messages, **kwargs):
+        calls.append(kwargs)
+        return [Response()]
+
+    monkeypatch.setattr(llm_calls, "raw_call_llm", raw_call_llm)
+    logprobs = asyncio.run(llm_calls.OpenAIBackend().top_logprobs(OpenAIChatModel(["m"]), [("user", "a")], k=2))
+    assert logprobs == {"1": -0.1, "2": -2.5}
+    assert calls == [{"max_tokens": 1, "temperature": 0, "logprobs": True, "top_logprobs": 2}]
+
+
+@pytest.mark.parametrize("logprobs", [None, [], {"1": -0.1}, [[("1", -0.1)]]])
+def test_openai_top_logprobs_rejects_unexpected_responses(monkeypatch, logprobs):
+    class Response:
+        completion = "1"
+
+    Response.logprobs = logprobs
+
+    async def raw_call_llm(llm, messages, **kwargs):
+        return [Response()]
+
+    monkeypatch.setattr(llm_calls, "raw_call_llm", raw_call_llm)
+    with pytest.raises(llm_calls.UnexpectedResponseError):
+        asyncio.run(llm_calls.OpenAIBackend().top_logprobs(OpenAIChatModel(["m"]), [("user", "a")], k=2))
+
+
+def test_logprob_evaluation_raises_on_unexpected_responses(monkeypatch):
+    from cpoison.base_models import DirectModel
+    from cpoison.eval import EvalTuple, logprob_evaluation
+
+    async def top_logprobs(self, llm, messages, k):
+        raise llm_calls.UnexpectedResponseError("no logprobs")
+
+    monkeypatch.setattr(FnBackend, "top_logprobs", top_logprobs)
+    with pytest.raises(llm_calls.UnexpectedResponseError):
+        asyncio.run(logprob_evaluation(EvalTuple("i", "a", "b"), DirectModel(OpenAIChatModel(["m"]))))
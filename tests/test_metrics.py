@@ -0,0 +1,24 @@
+import numpy as np
+
+from cpoison.metrics import bootstrap_ci, cluster_bootstrap_ci, summarize
+
+
+def test_single_run_groups_match_item_bootstrap():
+    n, k = np.array([[100, 0], [50, 10]]), np.array([[30, 0], [25, 5]])
+    lo, hi = cluster_bootstrap_ci(n, k, np.array([0, 1]), seed=1)
+    expected = bootstrap_ci(n, k, seed=1)
+    assert np.array_equal(lo, expected[0], equal_nan=True) and np.array_equal(hi, expected[1], equal_nan=True)
+    assert np.isnan(lo[0, 1]) and lo[1, 1] <= 0.5 <= hi[1, 1]
+
+
+def test_runs_which_disagree_widen_intervals():
+    # two groups with the same pooled rate, 0.5, but whose runs agree or disagree
+    n = np.full((8, 1), 100)
+    k = np.array([[50]] * 4 + [[10], [90], [10], [90]])
+    runs = [{"g": "agree"}] * 4 + [{"g": "disagree"}] * 4
+    summary = summarize(runs, n, k, metrics=["reg_acc_before"], by=["g"], n_boot=2000)
+    assert summary.groups == [("agree",), ("disagree",)]
+    assert np.allclose(summary.rate, 0.5)
+    widths = (summary.hi - summary.lo)[:, 0]
+    assert widths[1] > 3 * widths[0]
+    assert summary.lo[1, 0] < 0.3 and summary.hi[1, 0] > 0.7
@@ -0,0 +1,41 @@
+import asyncio
+
+from cpoison.eval import EvalTuple
+from cpoison.protocols import HighConfTrusted
+
+
+def fake_votes(votes: list[bool], batches: list[int]):
+    async def f(self, eval_tuple, n, offset=0):
+        assert offset == sum(batches)
+        batches.append(n)
+        return votes[offset : offset + n]
+
+    return f
+
+
+def test_adaptive_geometric_schedule(monkeypatch):
+    batches = []
+    monkeypatch.setattr(HighConfTrusted, "votes", fake_votes([True, False] * 10, batches))
+    protocol = HighConfTrusted(threshold=0.4, n=16, adaptive=True, batch_size=2, confidence=1.0)
+    prop, confident, meta = asyncio.run(protocol.trusted_prop(EvalTuple("i", "a", "b")))
+    assert batches == [2, 2, 4, 8]
+    assert meta["n_samples"] == sum(batches) and meta["n_requests"] == len(batches)
+    assert confident == protocol.is_confident(prop) and not confident
+
+
+def test_adaptive_stops_early_on_observed_votes(monkeypatch):
+    batches = []
+    monkeypatch.setattr(HighConfTrusted, "votes", fake_votes([True] * 20, batches))
+    protocol = HighConfTrusted(n=20, adaptive=True, batch_size=2)
+    prop, confident, meta = asyncio.run(protocol.trusted_prop(EvalTuple("i", "a", "b")))
+    assert prop == 1 and confident
+    assert meta["n_samples"] < 20 and meta["tokens_saved"] > 0
+
+
+def test_not_adaptive_single_request(monkeypatch):
+    batches = []
+    monkeypatch.setattr(HighConfTrusted, "votes", fake_votes([True] * 10, batches))
+    protocol = HighConfTrusted()
+    assert not protocol.adaptive
+    _, _, meta = asyncio.run(protocol.trusted_prop(EvalTuple("i", "a", "b")))
+    assert batches == [10] and meta == {"n_samples": 10}
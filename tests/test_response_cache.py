@@ -0,0 +1,65 @@
+import asyncio
+import itertools
+
+import pytest
+from lowstakes.llm import OpenAIChatModel
+
+from cpoison import llm_calls, response_cache
+from cpoison.llm_calls import FnBackend, call_llm, set_backend
+from cpoison.response_cache import ResponseCache, set_response_cache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(response_cache.time, "time", lambda: float(next(clock)))
+    return ResponseCache(tmp_path / "responses.sqlite", max_bytes=1000)
+
+
+def test_hit_and_miss_stats(cache):
+    assert cache.get("a") is None
+    cache.put("a", {"x": 1})
+    assert cache.get("a") == {"x": 1}
+    assert cache.get("b") is None
+    assert (cache.stats["hits"], cache.stats["misses"]) == (1, 2)
+    assert cache.hit_rate() == pytest.approx(1 / 3)
+    assert cache.stats["bytes_read"] == cache.stats["bytes_written"] == cache.total_bytes > 0
+
+
+def test_lru_eviction_under_max_bytes(cache):
+    value = "x" * 200
+    for key in "abcd":
+        cache.put(key, value)
+    cache.get("a")  # a is now more recent than b, c and d
+    cache.put("e", value)  # past max_bytes: evict down to 90% of it
+    assert cache.total_bytes <= 900
+    assert cache.get("a") == value and cache.get("e") == value
+    assert cache.get("b") is None
+    assert cache.get("c") == value and cache.stats["evicted"] == 1
+
+    reopened = ResponseCache(cache.path, max_bytes=1000)
+    assert reopened.total_bytes == cache.total_bytes
+
+
+def test_use_cache_false_never_reads_or_writes(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.sqlite")
+    set_response_cache(cache)
+    calls = []
+    set_backend(FnBackend(lambda messages: calls.append(messages) or "answer"))
+    llm = OpenAIChatModel(["gpt-3.5-turbo-0613"])
+    try:
+
+        async def main():
+            # the uncached call must not be coalesced with the cached one, nor the cached one with it
+            return await asyncio.gather(call_llm(llm, [("user", "a")], use_cache=False), call_llm(llm, [("user", "a")]))
+
+        asyncio.run(main())
+        assert len(calls) == 2 and cache.stats["bytes_written"] > 0
+        written = cache.stats["bytes_written"]
+        asyncio.run(call_llm(llm, [("user", "b")], use_cache=False))
+        assert cache.stats["bytes_written"] == written and cache.get(llm_calls.call_key(llm, [("user", "b")])) is None
+        asyncio.run(call_llm(llm, [("user", "a")], use_cache=False))
+        assert len(calls) == 4
+    finally:
+        set_response_cache(None)
+        set_backend(llm_calls.OpenAIBackend())
@@ -0,0 +1,67 @@
+import numpy as np
+
+from cpoison.columns import EvalTupleColumns, StrColumn
+from cpoison.eval import EvalTuple
+from cpoison.results import ResultStore
+
+
+def make_result(protocol: str, annotations: list[bool]) -> dict:
+    tuples = [EvalTuple(f"instruction {i}", f"output {i}a", f"output {i}b") for i in range(3)]
+    return {
+        "ft_id": f"ft_{protocol}",
+        "protocol": {"name": protocol},
+        "redteam": {"name": "rt"},
+        "version": "0.3",
+        "eval_tuples": tuples,
+        "labels": [True, False, True],
+        "annotations": annotations,
+        "exploits": ["x", "y", "z"],
+        "cues_amounts_1": [0.5, 1, 2.5],
+        "an_meta": [{"a": 1}, {"b": 2}, {}],
+        "stage_times": {"train": 1.5},
+        "gen_data": {"protocol": {"name": protocol}, "redteam": {"name": "rt"}, "version": "0.3", "labels": [True]},
+    }
+
+
+def test_round_trip(tmp_path):
+    store = ResultStore(tmp_path)
+    result = make_result("p", [True, True, False])
+    store.add(result, "run1", timestamp=1.0, job={"protocol": "p"})
+
+    r = store.load("run1")
+    assert r["job"] == {"protocol": "p"} and r["stage_times"] == {"train": 1.5}
+    assert isinstance(r["eval_tuples"], EvalTupleColumns) and list(r["eval_tuples"][1]) == list(
+        result["eval_tuples"][1]
+    )
+    assert isinstance(r["exploits"], StrColumn) and list(r["exploits"]) == ["x", "y", "z"]
+    assert r["annotations"].dtype == np.bool_ and r["annotations"].tolist() == [True, True, False]
+    assert r["cues_amounts_1"].tolist() == [0.5, 1.0, 2.5]
+    assert r["an_meta"] == result["an_meta"]
+    only_labels = store.load("run1", ["labels"])
+    assert "labels" in only_labels and "annotations" not in only_labels
+
+    back = store.to_gen_ft_data("run1")
+    assert back["gen_data"] == result["gen_data"]
+    assert back["eval_tuples"] == [list(t) for t in result["eval_tuples"]]
+    assert back["annotations"] == result["annotations"]
+
+    # a new store on the same folder sees the run
+    assert ResultStore(tmp_path).ids(protocol="p") == ["run1"]
+
+
+def test_identical_columns_are_stored_once(tmp_path):
+    store = ResultStore(tmp_path)
+    store.add(make_result("p1", [True, True, False]), "run1")
+    n_files = len(list((tmp_path / "columns").iterdir()))
+    store.add(make_result("p2", [False, False, False]), "run2")
+
+    # only the annotations differ
+    new_files = len(list((tmp_path / "columns").iterdir())) - n_files
+    assert new_files == 1
+    columns1, columns2 = store.meta("run1")["columns"], store.meta("run2")["columns"]
+    assert columns1["eval_tuples"] == columns2["eval_tuples"]
+    assert columns1["annotations"] != columns2["annotations"]
+    assert not list(tmp_path.rglob("*.tmp*"))
+
+    assert store.ids() == ["run1", "run2"]
+    assert store.ids(protocol="p2") == ["run2"]
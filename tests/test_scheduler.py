@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from cpoison import scheduler as scheduler_module
+from cpoison.scheduler import Scheduler, TokenBucket, priority
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(scheduler_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_token_bucket_refills(clock):
+    bucket = TokenBucket(per_minute=60)
+    bucket.last = clock[0]
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    clock[0] += 0.5
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert bucket.wait_time(1) == 0
+    clock[0] += 3600
+    assert bucket.wait_time(1) == 0 and bucket.level == 60  # capped at per_minute
+    assert bucket.wait_time(1000) == 0  # bigger than the bucket: goes through once it is full
+
+
+def test_priority_order():
+    async def main():
+        s = Scheduler(max_in_flight=1)
+        started = []
+
+        async def call(name: str):
+            await s.run("gpt-4", 1, lambda: asyncio.sleep(0.01, started.append(name)))
+
+        first = asyncio.ensure_future(call("first"))
+        await asyncio.sleep(0)
+        waiting = []
+        for name, p in [("low", 10), ("gold", 0), ("default", 5), ("gold 2", 0)]:
+            with priority(p):
+                waiting.append(asyncio.ensure_future(call(name)))
+        await asyncio.gather(first, *waiting)
+        assert started == ["first", "gold", "gold 2", "default", "low"]
+        assert s.in_flight == 0 and s.metrics()["gpt-4"]["started"] == 5
+
+    asyncio.run(main())
+
+
+def test_rate_limited_calls_wait_for_refill(monkeypatch):
+    monkeypatch.setitem(scheduler_module.RATE_LIMITS, "test-model", (600, 10**9))  # 10 requests per second
+
+    async def main():
+        s = Scheduler()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        times = []
+
+        async def call():
+            await s.run("test-model", 1, lambda: asyncio.sleep(0, times.append(loop.time() - start)))
+
+        await asyncio.gather(*(call() for _ in range(603)))
+        return times
+
+    times = sorted(asyncio.run(main()))
+    assert times[599] < 0.05  # the full bucket
+    assert 0.2 < times[-1] < 0.6  # then one every 0.1s
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from cpoison import stages
+from cpoison.stages import Stage, checkpointed, run_dag
+
+
+@pytest.fixture(autouse=True)
+def stage_folder(monkeypatch, tmp_path):
+    monkeypatch.setattr(stages, "STAGE_FOLDER", tmp_path)
+    return tmp_path
+
+
+def test_checkpointed_runs_once_per_key(stage_folder):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    async def main():
+        first = await checkpointed("stage", ["a", 1], fn)
+        hit = await checkpointed("stage", ["a", 1], fn)
+        miss = await checkpointed("stage", ["a", 2], fn)
+        other_name = await checkpointed("other", ["a", 1], fn)
+        return first, hit, miss, other_name
+
+    assert asyncio.run(main()) == ({"n": 1}, {"n": 1}, {"n": 2}, {"n": 3})
+    assert len(calls) == 3
+    assert len(list(stage_folder.glob("*.json"))) == 3 and not list(stage_folder.glob("*.tmp"))
+
+
+def test_checkpointed_encode_decode():
+    async def main():
+        fn = lambda: asyncio.sleep(0, {1, 2})
+        kwargs = dict(encode=sorted, decode=set)
+        return await checkpointed("set", [], fn, **kwargs), await checkpointed("set", [], fn, **kwargs)
+
+    assert asyncio.run(main()) == ({1, 2}, {1, 2})
+
+
+def test_failed_stage_is_not_checkpointed():
+    async def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        asyncio.run(checkpointed("stage", [], fail))
+    assert asyncio.run(checkpointed("stage", [], lambda: asyncio.sleep(0, "ok"))) == "ok"
+
+
+def test_run_dag_order():
+    events = []
+
+    def stage(name: str, delay: float):
+        async def fn(**inputs):
+            events.append(f"start {name}")
+            await asyncio.sleep(delay)
+            events.append(f"end {name}")
+            return name + "".join(f"({v})" for v in inputs.values())
+
+        return fn
+
+    results, times = asyncio.run(
+        run_dag(
+            {
+                "c": Stage(["a", "b"], stage("c", 0)),
+                "a": Stage([], stage("a", 0.05)),
+                "b": Stage([], stage("b", 0.01)),
+                "d": Stage(["b"], stage("d", 0)),
+            }
+        )
+    )
+    assert results == {"c": "c(a)(b)", "a": "a", "b": "b", "d": "d(b)"}
+    assert times.keys() == results.keys() and times["a"] >= 0.05
+    # independent stages run concurrently, and each starts as soon as its own dependencies are done
+    assert events.index("start b") < events.index("end a")
+    assert events.index("end b") < events.index("start d") < events.index("end a") < events.index("start c")
+
+
+def test_run_dag_unknown_dependency():
+    with pytest.raises(AssertionError, match="unknown stages"):
+        asyncio.run(run_dag({"a": Stage(["missing"], lambda missing: asyncio.sleep(0))}))
+
+
+def test_run_dag_failure_cancels_other_stages():
+    finished = []
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        finished.append("slow")
+
+    async def fail():
+        raise ValueError("stage failed")
+
+    async def main():
+        with pytest.raises(ValueError, match="stage failed"):
+            await run_dag({"slow": Stage([], slow), "fail": Stage([], fail)})
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert finished == []
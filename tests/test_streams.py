@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from cpoison.streams import collect, stream_map
+
+
+async def double(i: int, x: int) -> int:
+    await asyncio.sleep(0.001 * (x % 3))
+    return 2 * x
+
+
+def test_results_are_complete():
+    async def main():
+        unordered = await collect(stream_map(double, enumerate(range(50)), concurrency=4, buffer=2))
+        ordered = [y async for _, y in stream_map(double, enumerate(range(50)), concurrency=4, ordered=True)]
+        return unordered, ordered
+
+    unordered, ordered = asyncio.run(main())
+    assert unordered == ordered == [2 * x for x in range(50)]
+
+
+def test_slow_consumer_applies_backpressure():
+    pulled = []
+
+    def items():
+        for i in range(1000):
+            pulled.append(i)
+            yield i, i
+
+    async def main():
+        stream = stream_map(double, items(), concurrency=2, buffer=2)
+        await stream.__anext__()
+        await asyncio.sleep(0.1)
+        n_pulled = len(pulled)
+        await stream.aclose()
+        return n_pulled
+
+    # queues in and out, items in the workers, and the one the feeder holds
+    assert asyncio.run(main()) <= 2 * 2 + 2 + 2
+
+
+def test_fn_exception_reaches_consumer():
+    started = []
+
+    async def fail_on_3(i: int, x: int) -> int:
+        started.append(i)
+        if x == 3:
+            raise ValueError("bad item")
+        await asyncio.sleep(0.01)
+        return x
+
+    async def main():
+        with pytest.raises(ValueError, match="bad item"):
+            await collect(stream_map(fail_on_3, enumerate(range(1000)), concurrency=4, buffer=4))
+
+    asyncio.run(main())
+    assert len(started) < 1000  # the remaining items are cancelled
+
+
+def test_items_exception_reaches_consumer():
+    def items():
+        yield 0, 0
+        raise KeyError("broken source")
+
+    async def main():
+        with pytest.raises(KeyError, match="broken source"):
+            await collect(stream_map(double, items()))
+
+    asyncio.run(main())
+
+
+def test_chained_streams():
+    async def main():
+        s = stream_map(double, enumerate(range(20)), concurrency=3, buffer=1)
+        s = stream_map(double, s, concurrency=2, buffer=1)
+        return await collect(s, 20)
+
+    assert asyncio.run(main()) == [4 * x for x in range(20)]
@@ -0,0 +1,30 @@
+import asyncio
+
+from cpoison import sweep
+from cpoison.sweep import expand_grid, run_job
+
+
+def test_symmetric_eval_is_a_grid_axis(monkeypatch, capsys):
+    calls = []
+
+    async def gen_and_ft(protocol, redteam, **kwargs):
+        calls.append(kwargs)
+        bias = {"n": 2, "pref_first": 0.75, "position_bias": 0.25, "inconsistent": 0.5}
+        return {"position_bias": {"annotations": bias} if kwargs.get("symmetric_eval") else {}}
+
+    monkeypatch.setattr(sweep, "gen_and_ft", gen_and_ft)
+    grid = [
+        {
+            "protocol": {"name": "UseTrusted"},
+            "redteam": {"name": "Dumb"},
+            "n_supervised": 10,
+            "symmetric_eval": [False, True],
+        }
+    ]
+    jobs = expand_grid(grid)
+    assert [job["symmetric_eval"] for job in jobs] == [False, True]
+
+    for job in jobs:
+        asyncio.run(run_job(job))
+    assert calls == [{"n_supervised": 10, "symmetric_eval": False}, {"n_supervised": 10, "symmetric_eval": True}]
+    assert capsys.readouterr().out.count("Position bias of annotations (UseTrusted vs Dumb)") == 1